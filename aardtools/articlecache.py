@@ -0,0 +1,275 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+Persistent cache of converted articles, reused across compilations.
+
+Cached article is looked up by hash of its title and raw text and is
+valid only if pages it fetched when it was rendered (templates) are
+unchanged: for each such page cache stores hash of its text, or None
+if page didn't exist.
+
+Cache is an sqlite database. Any number of processes may read it, but
+only one should write. sqlite connection can't be carried across
+fork(), so process that forks workers writes through
+:class:`CacheWriter`, which keeps the writing connection in a process
+of it's own.
+"""
+
+from __future__ import with_statement
+import logging
+import sqlite3
+import time
+import zlib
+from hashlib import sha1
+from multiprocessing import Process, Pipe
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+log = logging.getLogger('articlecache')
+
+#Number of changes written to cache in one transaction
+COMMIT_SIZE = 1000
+
+#Changes whenever meaning of stored entries changes, so that entries
+#written by older versions are never found. Version 1 entries held
+#articles compressed for output volumes.
+CACHE_FORMAT = '2'
+
+SCHEMA = '''
+create table if not exists articles (
+    key text primary key,
+    dependencies text,
+    languagelinks text,
+    codec text,
+    size integer,
+    seconds real,
+    article blob,
+    used integer
+)
+'''
+
+def digest(text):
+    """ Return hash of page text to record as article dependency.
+
+    >>> digest(None)
+    >>> digest(u'abc') == digest('abc')
+    True
+
+    """
+    if text is None:
+        return None
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return sha1(text).hexdigest()
+
+
+class CacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        #conversion time of cached articles minus time spent
+        #looking them up
+        self.saved = 0.0
+
+    hit_rate = property(lambda self: (100.0*self.hits/(self.hits + self.misses)
+                                      if self.hits + self.misses else 0.0))
+
+    def __str__(self):
+        return ('hits: %d, misses: %d, hit rate: %.1f%%, '
+                'time saved: %.1fs' % (self.hits, self.misses,
+                                       self.hit_rate, self.saved))
+
+
+class ArticleCache(object):
+    """ Cache of serialized articles. Articles are stored
+    uncompressed as far as callers are concerned (cache compresses them
+    with zlib internally), so one cache can serve compilations with any
+    output compression or format version. `salt` identifies
+    everything else that affects conversion result (converter
+    version, site info, filters), entries stored with different salt
+    are never found.
+    """
+
+    def __init__(self, file_name, salt=''):
+        self.file_name = file_name
+        self.salt = salt
+        self.conn = sqlite3.connect(file_name, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+        #stamp marking entries used in this run
+        self.run = int(time.time())
+        self.changes = 0
+        self.stats = CacheStats()
+
+    def key(self, title, text):
+        h = sha1(CACHE_FORMAT)
+        h.update(self.salt)
+        h.update(title.encode('utf8'))
+        h.update('\0')
+        h.update(text.encode('utf8'))
+        return h.hexdigest()
+
+    def get(self, key, page_digest):
+        """ Return tuple of serialized article, language links and
+        conversion time for cached article, or
+        None if article is not in cache or any of it's dependencies
+        changed. `page_digest` is a function returning current
+        :func:`digest` of page with given name.
+        """
+        row = self.conn.execute('select dependencies, languagelinks, '
+                                'codec, size, seconds, article '
+                                'from articles where key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        dependencies, languagelinks, codec, size, seconds, article = row
+        for name, page_hash in json.loads(dependencies):
+            if page_digest(name) != page_hash:
+                return None
+        article = str(article)
+        if codec == 'zlib':
+            article = zlib.decompress(article)
+        return article, json.loads(languagelinks), seconds
+
+    def put(self, key, dependencies, article, languagelinks, seconds):
+        """ Store converted article. `dependencies` is a sequence of
+        page name and page :func:`digest` pairs.
+        """
+        self.conn.execute('insert or replace into articles '
+                          'values (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (key, json.dumps(sorted(dependencies)),
+                           json.dumps(languagelinks), 'zlib', len(article),
+                           seconds, sqlite3.Binary(zlib.compress(article)),
+                           self.run))
+        self.stats.misses += 1
+        self.changed()
+
+    def touch(self, key, saved):
+        """ Mark article as used in this run. `saved` is the time
+        cache hit saved.
+        """
+        self.conn.execute('update articles set used = ? where key = ?',
+                          (self.run, key))
+        self.stats.hits += 1
+        self.stats.saved += saved
+        self.changed()
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= COMMIT_SIZE:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.changes = 0
+
+    def prune(self):
+        """ Remove articles not used in this run, return number of
+        removed articles.
+        """
+        self.commit()
+        cursor = self.conn.execute('delete from articles where used < ?',
+                                   (self.run,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def _write(conn, file_name, salt):
+    cache = ArticleCache(file_name, salt)
+    error = None
+    conn.send(None)
+    while True:
+        try:
+            name, args = conn.recv()
+        except (EOFError, IOError):
+            break
+        try:
+            result = getattr(cache, name)(*args)
+        except Exception, e:
+            log.exception('Article cache %s failed', name)
+            #reported back on next call that waits for result
+            error = error or e
+            result = None
+        if name in CacheWriter.replies:
+            conn.send((result, error))
+            error = None
+        if name == 'close':
+            break
+    conn.close()
+
+
+class CacheWriter(object):
+    """ Writes articles to :class:`ArticleCache` in a separate
+    process, has the same writing methods. Must be created before
+    the process opens any connection to the cache and before it
+    forks workers that read it, so that no sqlite connection is
+    inherited by forked processes. Cache schema is ready when
+    constructor returns.
+    """
+
+    #methods that wait for writer process to return result
+    replies = frozenset(('commit', 'prune', 'close'))
+
+    def __init__(self, file_name, salt=''):
+        self.file_name = file_name
+        self.stats = CacheStats()
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_write,
+                               args=(child_conn, file_name, salt))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.conn.recv()
+
+    def call(self, name, *args):
+        self.conn.send((name, args))
+        if name in self.replies:
+            result, error = self.conn.recv()
+            if error:
+                raise error
+            return result
+
+    def put(self, key, dependencies, article, languagelinks, seconds):
+        self.call('put', key, list(dependencies), article,
+                  languagelinks, seconds)
+        self.stats.misses += 1
+
+    def touch(self, key, saved):
+        self.call('touch', key, saved)
+        self.stats.hits += 1
+        self.stats.saved += saved
+
+    def commit(self):
+        self.call('commit')
+
+    def prune(self):
+        return self.call('prune')
+
+    def close(self):
+        try:
+            self.call('close')
+        finally:
+            self.conn.close()
+            self.process.join()
@@ -35,7 +35,10 @@ try:
 except ImportError:
     import simplejson as json
 
-from aarddict.dictionary import HEADER_SPEC, spec_len, calcsha1, collation_key
+from hashlib import sha1
+
+from aarddict.dictionary import (HEADER_SPEC, spec_len, collation_key,
+                                 decompress)
 import aardtools
 
 
@@ -48,6 +51,13 @@ MAX_FAT32_FILE_SIZE = 2**32-1
 KEY_LENGTH_FORMAT = '>H'
 ARTICLE_LENGTH_FORMAT = '>L'
 INDEX1_ITEM_FORMAT = '>LL'
+#Format version 2 index 1 item: key pointer, block pointer and
+#article pointer in uncompressed block
+INDEX1_BLOCK_ITEM_FORMAT = '>LLL'
+#Format version of files laid out same as version 1 whose articles may
+#be compressed with preset dictionary from metadata, so that viewers
+#that only read version 1 refuse them rather than show compressed data
+DICTIONARY_FORMAT_VERSION = 3
 
 def make_opt_parser():
     usage = "Usage: %prog [options] (wiki|xdxf|aard) FILE"
@@ -89,7 +99,34 @@ def make_opt_parser():
         default=2.0,
         help=
         'Skip article if it was not process in the amount of time '
-        'specified. Default: %defaults'
+        'specified, plus time allowed for article size (see '
+        '--timeout-per-kb). Default: %defaults'
+        )
+    parser.add_option(
+        '--timeout-per-kb',
+        type='float',
+        default=0.05,
+        help=
+        'Additional time allowed for converting each kilobyte of article '
+        'source. Default: %defaults'
+        )
+    parser.add_option(
+        '--retry-processes',
+        type='int',
+        default=1,
+        help=
+        'Number of worker processes to convert articles that timed out '
+        'with again, with much longer timeout (see --retry-timeout-factor). '
+        'Articles are retried after each chunk of articles (see '
+        '--mp-chunk-size), 0 disables retrying. Default: %default'
+        )
+    parser.add_option(
+        '--retry-timeout-factor',
+        type='float',
+        default=10,
+        help=
+        'Retried articles are given this many times more time than at '
+        'first. Default: %default'
         )
     parser.add_option(
         '--processes',
@@ -124,9 +161,132 @@ def make_opt_parser():
         '--work-dir',
         default='.',
         help=
-        'Directory for temporary file created during compilatiod. '
+        'Directory for temporary file created during compilatiod, or '
+        'comma separated list of directories (preferably on different '
+        'disks) to spread temporary files across. Session directory is '
+        'created in the first one. Default: %default'
+        )
+    parser.add_option(
+        '--hot-work-dir',
+        default=None,
+        help=
+        'Directory for small temporary files that are read at random '
+        'when compiling (titles, article index, sort keys), such as a '
+        'tmpfs mount. Files in memory backed directory do not survive '
+        'reboot, session can\'t be resumed then'
+        )
+    parser.add_option(
+        '--sort-memory',
+        default='512M',
+        help=
+        'Approximate amount of memory to use for sorting articles, '
+        'in bytes, kilobytes(K), megabytes(M) or gigabytes(G). If more '
+        'is needed, sorted runs are written to temporary files in session '
+        'directory and merged. Default: %default'
+        )
+    parser.add_option(
+        '--prefetch-size',
+        default='16M',
+        help=
+        'Amount of data to read ahead when articles are read from '
+        'temporary storage in sorted order, in bytes, kilobytes(K) or '
+        'megabytes(M), 0 disables read ahead. Default: %default'
+        )
+    parser.add_option(
+        '--presorted',
+        action='store_true',
+        default=False,
+        help=
+        'Input is expected to be in sorted order already, such as aard '
+        'files. Sort keys are then not stored, which saves disk space. '
+        'Articles that come in sorted order are never sorted, with or '
+        'without this option, and if order turns out to be broken '
+        'articles are sorted anyway'
+        )
+    parser.add_option(
+        '--sort-processes',
+        type='int',
+        default=1,
+        help=
+        'Number of worker processes to sort articles with. Articles are '
+        'split into this many key ranges which are sorted in parallel. '
+        'Default: %default'
+        )
+    parser.add_option(
+        '--volume-processes',
+        type='int',
+        default=1,
+        help=
+        'Number of worker processes to write volumes with, volumes are '
+        'planned first and then written in parallel. Default: %default'
+        )
+    parser.add_option(
+        '--compress-threads',
+        type='int',
+        default=0,
+        help=
+        'Number of threads to compress articles in while converter keeps '
+        'parsing input (0 - compress in converter\'s thread). Not used by '
+        'wiki converter, wiki articles are compressed in worker processes. '
         'Default: %default'
         )
+    parser.add_option(
+        '--compression',
+        default='best',
+        choices=sorted(compression_policies),
+        help=
+        'Article compression: best (compress with both zlib and bz2, '
+        'keep smaller result), zlib, bz2 or adaptive (sample articles '
+        'of each size class with both, then use zlib unless bz2 '
+        'is noticeably smaller), zdict (same as best plus zlib with '
+        'preset dictionary trained on first articles; such files get '
+        'format version 3, or stay version 2, and can not be opened by '
+        'viewers that only support version 1) or none. With format '
+        'version 2 applies to article blocks. Default: %default'
+        )
+    parser.add_option(
+        '--format-version',
+        default=1,
+        type='int',
+        help=
+        'Aard format version: 1 - each article is compressed on it\'s own, '
+        '2 - consecutive articles are compressed together in blocks '
+        '(files can not be opened by viewers that only support '
+        'version 1). Default: %default'
+        )
+    parser.add_option(
+        '--block-size',
+        default='64K',
+        help=
+        'Uncompressed size of article blocks for format version 2 in bytes, '
+        'kilobytes(K) or megabytes(M). Default: %default'
+        )
+    parser.add_option(
+        '--no-dedup',
+        action='store_true',
+        default=False,
+        help=
+        'Do not look for articles with identical content, by default '
+        'such content is written once per volume and shared'
+        )
+    parser.add_option(
+        '--checkpoint-interval',
+        default=600,
+        type='int',
+        help=
+        'Save state of collected articles to session directory '
+        'at most once in this many seconds so that interrupted '
+        'compilation can be resumed, 0 to disable. Only '
+        'supported for wiki input. Default: %default'
+        )
+    parser.add_option(
+        '--resume',
+        metavar='SESSION_DIR',
+        help=
+        'Resume interrupted compilation from last checkpoint saved in '
+        'session directory SESSION_DIR. Options and input files '
+        'are the same as in interrupted compilation'
+        )
     parser.add_option(
         '--start',
         default=0,
@@ -165,12 +325,50 @@ def make_opt_parser():
         '--mp-chunk-size',
         default=10000,
         type='int',
-        help='This value defines maximum number articles to be processed by pool'
-        'of worker processes before it is closed and new pool is created. Typically'
-        'there should be no need to change the default value.'
+        help='Maximum number of articles handed out to worker processes '
+        'before waiting for all of them to be done and saving checkpoint. '
+        'Typically there should be no need to change the default value. '
+        'Default: %default'
+        )
+
+    parser.add_option(
+        '--largest-first',
+        action='store_true',
+        default=False,
+        help='Hand out articles in each chunk (see --mp-chunk-size) '
+        'to worker processes largest first, so that workers are not left '
+        'waiting for a few large articles at the end of the chunk. '
+        'Worker utilisation is logged at the end of conversion'
+        )
+
+    parser.add_option(
+        '--max-batch-size',
+        default=64,
+        type='int',
+        help='Maximum number of articles sent to worker process at once. '
+        'Batch size adapts to article conversion time, so that small '
+        'articles and redirects are sent in larger batches, '
+        '1 - send articles one by one. Default: %default'
+        )
+
+    parser.add_option(
+        '--worker-tasks',
+        default=2000,
+        type='int',
+        help='Replace worker process with a new one after it converted this '
+        'many articles, 0 - keep workers for the whole compilation. '
         'Default: %default'
         )
 
+    parser.add_option(
+        '--worker-max-age',
+        default=0,
+        type='int',
+        help='Replace all worker processes once they are running longer than '
+        'this many seconds, checked between article chunks (see '
+        '--mp-chunk-size), 0 - never. Default: %default'
+        )
+
     parser.add_option(
         '--show-legend',
         action='store_true',
@@ -190,6 +388,19 @@ def make_opt_parser():
         help='Add Wikipedia language links to index for these languages '
         '(comma separated list of language codes). Default: %default')
 
+    parser.add_option(
+        '--article-cache',
+        metavar='FILE',
+        help='Reuse articles converted in previous compilations if '
+        'neither article text nor templates it uses changed, '
+        'keep converted articles in this cache file. Wiki input only')
+
+    parser.add_option(
+        '--prune-article-cache',
+        action='store_true',
+        help='Remove articles not used in this compilation '
+        'from article cache')
+
     parser.add_option(
         '--article-count',
         default=0,
@@ -233,61 +444,107 @@ def utf8(func):
     return f
 
 class Volume(object):
+    """ Volume plan: range of articles in sorted order that fit into one
+    file no bigger than maximum file size, and section lengths.
+    """
 
     class ExceedsMaxSize(Exception): pass
 
     number = 0
 
-    def __init__(self, header_meta_len, max_file_size, work_dir):
+    def __init__(self, header_meta_len, max_file_size, first=0):
         self.header_meta_len = header_meta_len
         self.max_file_size = max_file_size
-        self.index1 = tempfile.NamedTemporaryFile(prefix='index1',
-                                                  dir=work_dir)
-        log.info('Creating temporary index 1 file %s', self.index1.name)
-        self.index2 = tempfile.NamedTemporaryFile(prefix='index2',
-                                                  dir=work_dir)
-        log.info('Creating temporary index 2 file %s', self.index2.name)
-        self.articles =  tempfile.NamedTemporaryFile(prefix='articles',
-                                                     dir=work_dir)
-        log.info('Creating temporary articles file %s', self.articles.name)
+        #position of volume's first article in sorted order
+        self.first = first
         self.index1Length = 0
         self.index2Length = 0
         self.articles_len = 0
         self.index_count = 0
         Volume.number += 1
+        self.number = Volume.number
 
-    def add(self, index1_unit, index2_unit, article_unit):
+    end = property(lambda self: self.first + self.index_count)
+
+    def add(self, title_len, article_len, duplicate=False):
+        index1_unit_len = struct.calcsize(INDEX1_ITEM_FORMAT)
+        index2_unit_len = struct.calcsize(KEY_LENGTH_FORMAT) + title_len
+        if duplicate:
+            #body is already in this volume
+            article_unit_len = 0
+        else:
+            article_unit_len = struct.calcsize(ARTICLE_LENGTH_FORMAT) + article_len
         if sum((self.header_meta_len,
                 self.index1Length,
                 self.index2Length,
                 self.articles_len,
-                len(index1_unit),
-                len(index2_unit),
-                len(article_unit)
+                index1_unit_len,
+                index2_unit_len,
+                article_unit_len
                 )) > self.max_file_size:
             raise Volume.ExceedsMaxSize
-        self.index1.write(index1_unit)
-        self.index1Length += len(index1_unit)
-        self.index2.write(index2_unit)
-        self.index2Length += len(index2_unit)
+        self.index1Length += index1_unit_len
+        self.index2Length += index2_unit_len
         self.index_count += 1
-        self.articles.write(article_unit)
-        self.articles_len += len(article_unit)
+        self.articles_len += article_unit_len
 
 
-    def flush(self):
-        self.index1.flush()
-        self.index2.flush()
-        self.articles.flush()
+class BlockVolume(Volume):
+    """ Volume plan for format version 2, articles are packed into
+    compressed blocks (see :class:`ArticleBlocks`) and count towards
+    volume size as blocks are closed. Volume's blocks and index 1
+    start at `blocks_start` and `index1_start` in block files.
+    """
+
+    def __init__(self, header_meta_len, max_file_size, first=0,
+                 blocks_start=0, index1_start=0):
+        Volume.__init__(self, header_meta_len, max_file_size, first)
+        self.blocks_start = blocks_start
+        self.index1_start = index1_start
+
+    def add(self, title_len, pending_len):
+        """ Add index entry, `pending_len` is the maximum length open
+        block may have if article is added to it.
+        """
+        index1_unit_len = struct.calcsize(INDEX1_BLOCK_ITEM_FORMAT)
+        index2_unit_len = struct.calcsize(KEY_LENGTH_FORMAT) + title_len
+        if sum((self.header_meta_len,
+                self.index1Length,
+                self.index2Length,
+                self.articles_len,
+                index1_unit_len,
+                index2_unit_len,
+                pending_len
+                )) > self.max_file_size:
+            raise Volume.ExceedsMaxSize
+        self.index1Length += index1_unit_len
+        self.index2Length += index2_unit_len
+        self.index_count += 1
 
-    def totuple(self):
-        return (self.index1, self.index1Length, self.index2,
-                self.index2Length, self.articles, self.articles_len,
-                self.index_count)
+    def add_block(self, block_len):
+        self.articles_len += block_len
 
 import threading
+from Queue import Queue, Empty, Full
+from collections import deque
+from multiprocessing.pool import ThreadPool
 article_add_lock = threading.RLock()
 
+#Maximum number of articles waiting for compression, per thread
+COMPRESS_QUEUE_SIZE = 16
+
+class DoneResult(object):
+    """ Result of an article that needs no compression, queued
+    with articles compressed in thread pool to keep submission
+    order (has :meth:`get` like :class:`AsyncResult`).
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
 class Stats(object):
 
     def __init__(self):
@@ -297,11 +554,17 @@ class Stats(object):
         self.failed = 0
         self.empty = 0
         self.timedout = 0
+        #articles that timed out and were converted when retried
+        self.recovered = 0
         self.articles = 0
         self.redirects = 0
         self.start_time = time.time()
         self.article_start_time = 0
         self.processed_bytes = 0
+        #redirects stored without compression, including uncounted
+        #ones, and time spent storing them
+        self.redirect_stubs = 0
+        self.redirect_time = 0.0
 
     processed = property(lambda self: (self.articles +
                                        self.redirects +
@@ -319,127 +582,1117 @@ class Stats(object):
 
     def __str__(self):
         return ('total: %d, skipped: %d, failed: %d, '
-                'empty: %d, timed out: %d, articles: %d, '
-                'redirects: %d, average: %.2f/s '
+                'empty: %d, timed out: %d, recovered: %d, articles: %d, '
+                'redirects: %d, redirect stubs: %d in %.1fs, '
+                'average: %.2f/s '
                 'elapsed: %s' % (self.total,
                                  self.skipped,
                                  self.failed,
                                  self.empty,
                                  self.timedout,
+                                 self.recovered,
                                  self.articles,
                                  self.redirects,
+                                 self.redirect_stubs,
+                                 self.redirect_time,
                                  self.average,
                                  self.elapsed))
 
+    counters = ('total', 'total_bytes', 'skipped', 'failed', 'empty',
+                'timedout', 'recovered', 'articles', 'redirects',
+                'processed_bytes', 'redirect_stubs', 'redirect_time')
+
+    def checkpoint(self):
+        state = dict((name, getattr(self, name)) for name in self.counters)
+        t = time.time()
+        state['elapsed'] = t - self.start_time
+        state['article_elapsed'] = (t - self.article_start_time
+                                    if self.article_start_time else 0)
+        return state
+
+    def restore(self, state):
+        for name in self.counters:
+            setattr(self, name, state[name])
+        t = time.time()
+        self.start_time = t - state['elapsed']
+        self.article_start_time = t - state['article_elapsed']
+
 
 import mmap
+import heapq
+import random
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from multiprocessing import Pool
+
+#Approximate memory taken by one (key, position) tuple in a sort run,
+#not counting key length
+SORT_ITEM_OVERHEAD = 128
+SORT_RUN_ITEM_FORMAT = '>LL'
+
+def write_sort_run(run, work_dir=None):
+    """ Write sorted list of (key, position) tuples to a temporary file
+    and return file name. Keys must be byte strings.
+    """
+    fd, run_name = tempfile.mkstemp(prefix='aa-', suffix='.run', dir=work_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for k, i in run:
+            f.write(struct.pack(SORT_RUN_ITEM_FORMAT, i, len(k)))
+            f.write(k)
+    return run_name
+
+def read_sort_run(run_name):
+    """ Generate (key, position) tuples from file written by
+    :func:`write_sort_run`, remove the file when done.
+    """
+    item_size = struct.calcsize(SORT_RUN_ITEM_FORMAT)
+    try:
+        with open(run_name, 'rb', 1024*1024) as f:
+            while True:
+                s = f.read(item_size)
+                if not s:
+                    break
+                i, key_len = struct.unpack(SORT_RUN_ITEM_FORMAT, s)
+                yield f.read(key_len), i
+    finally:
+        os.remove(run_name)
+
+def sort_items(items, max_memory=None, work_dir=None):
+    """ Generate (key, position) tuples from `items` in sorted
+    order. Items are collected into runs of at most `max_memory`
+    bytes, each full run is sorted and written to a temporary file
+    in `work_dir`, then all runs are merged. All items are sorted
+    in memory if `max_memory` is not set.
+    """
+    runs = []
+    run = []
+    run_size = 0
+    for item in items:
+        run.append(item)
+        if max_memory:
+            run_size += len(item[0]) + SORT_ITEM_OVERHEAD
+            if run_size > max_memory:
+                run.sort()
+                runs.append(write_sort_run(run, work_dir))
+                run = []
+                run_size = 0
+    run.sort()
+    if runs:
+        log.info('Merging %d sorted runs', len(runs) + 1)
+    return heapq.merge(iter(run), *[read_sort_run(run_name)
+                                    for run_name in runs])
+
+def external_sort(count, key, max_memory, work_dir=None):
+    """ Generate positions 0..count-1 ordered by key, positions with
+    equal keys stay in original order (same as ``sorted``). Memory
+    used for sorting is limited to approximately `max_memory` bytes
+    (see :func:`sort_items`).
+
+    >>> list(external_sort(5, lambda i: 'bcaab'[i], 300))
+    [2, 3, 0, 4, 1]
+    >>> list(external_sort(0, lambda i: 'x', 300))
+    []
+
+    """
+    for k, i in sort_items(((key(i), i) for i in xrange(count)),
+                           max_memory, work_dir):
+        yield i
+
+#Number of sampled keys per partition used to pick partition boundaries
+SORT_SAMPLE_SIZE = 100
+POSITION_FORMAT = 'I'
+
+def sort_partition(args):
+    """ Sort partition file written by :func:`partitioned_sort` and
+    write sorted positions to a new temporary file, return its name.
+    Runs in worker process.
+    """
+    partition_name, max_memory, work_dir = args
+    fd, sorted_name = tempfile.mkstemp(prefix='aa-', suffix='.sorted',
+                                       dir=work_dir)
+    with os.fdopen(fd, 'wb') as f:
+        positions = array(POSITION_FORMAT)
+        for k, i in sort_items(read_sort_run(partition_name),
+                               max_memory, work_dir):
+            positions.append(i)
+            if len(positions) == 65536:
+                positions.tofile(f)
+                del positions[:]
+        positions.tofile(f)
+    return sorted_name
+
+def read_positions(positions_name):
+    """ Generate positions from file written by :func:`sort_partition`,
+    remove the file when done.
+    """
+    itemsize = array(POSITION_FORMAT).itemsize
+    try:
+        with open(positions_name, 'rb') as f:
+            while True:
+                s = f.read(65536*itemsize)
+                if not s:
+                    break
+                for i in array(POSITION_FORMAT, s):
+                    yield i
+    finally:
+        os.remove(positions_name)
+
+def partitioned_sort(count, key, processes, max_memory=None, work_dir=None):
+    """ Generate positions 0..count-1 ordered by key, same as
+    :func:`external_sort`. Sampled keys are used to pick key range
+    boundaries, records are routed into `processes` partition files
+    which are sorted in parallel by a pool of worker processes. Since
+    partitions cover consecutive key ranges sorted partitions are
+    simply concatenated.
+
+    Keys must be byte strings.
+    """
+    if not count:
+        return
+    sample = sorted(key(i) for i in
+                    random.sample(xrange(count),
+                                  min(count, SORT_SAMPLE_SIZE*processes)))
+    boundaries = [sample[len(sample)*j/processes]
+                  for j in range(1, processes)]
+    #All files of this sort, including runs spilled by workers, go
+    #into a directory of their own so that whatever is not consumed
+    #when sorting stops early is removed along with it
+    sort_dir = tempfile.mkdtemp(prefix='aa-sort-', dir=work_dir)
+    partitions = []
+    pool = None
+    try:
+        for j in range(processes):
+            fd, partition_name = tempfile.mkstemp(prefix='aa-', suffix='.run',
+                                                  dir=sort_dir)
+            partitions.append((partition_name,
+                               os.fdopen(fd, 'wb', 1024*1024)))
+        log.info('Routing %d keys into %d partitions', count, processes)
+        for i in xrange(count):
+            k = key(i)
+            f = partitions[bisect_right(boundaries, k)][1]
+            f.write(struct.pack(SORT_RUN_ITEM_FORMAT, i, len(k)))
+            f.write(k)
+        for partition_name, f in partitions:
+            f.close()
+        partition_memory = max_memory/processes if max_memory else None
+        pool = Pool(processes=processes)
+        for sorted_name in pool.imap(sort_partition,
+                                     [(partition_name, partition_memory, sort_dir)
+                                      for partition_name, f in partitions]):
+            for i in read_positions(sorted_name):
+                yield i
+    finally:
+        if pool:
+            pool.terminate()
+        for partition_name, f in partitions:
+            f.close()
+        shutil.rmtree(sort_dir, ignore_errors=True)
+
+def map_file(file_name):
+    """ Return read only memory map of the file, or empty string
+    if file is empty (empty files can't be mapped).
+    """
+    if not os.path.getsize(file_name):
+        return ''
+    with open(file_name, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#Spans are copied in slices at most this long, so that copying a
+#large span doesn't read all of it into memory at once
+COPY_SLICE_SIZE = 8*1024*1024
+
+class VolumeFile(object):
+    """ Output volume file that calculates sha1 sum of content
+    following signature and sha1 bytes as it is written.
+    """
+
+    def __init__(self, file_name):
+        self.name = file_name
+        self.f = open(file_name, 'wb', 1024*1024)
+        self.sha1 = sha1()
+        self.checksum_offset = spec_len(HEADER_SPEC[:2])
+        self.pos = 0
+
+    def _update(self, data):
+        skip = self.checksum_offset - self.pos
+        self.pos += len(data)
+        if skip > 0:
+            data = data[skip:]
+        self.sha1.update(data)
+
+    def write(self, data):
+        self.f.write(data)
+        self._update(data)
+
+    def copy(self, src_map, start, length):
+        """ Write `length` bytes of memory mapped source file starting
+        at `start`, in slices of no more than `COPY_SLICE_SIZE` bytes.
+        """
+        end = start + length
+        while start < end:
+            self.write(src_map[start:min(start + COPY_SLICE_SIZE, end)])
+            start += COPY_SLICE_SIZE
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def close(self):
+        """ Write sha1 sum to the header and close the file, return
+        sha1 sum.
+        """
+        sha1sum = self.hexdigest()
+        self.f.seek(spec_len(HEADER_SPEC[:1]))
+        self.f.write(sha1sum)
+        self.f.close()
+        return sha1sum
+
+#Number of index items packed and written at once
+INDEX_BLOCK_ITEMS = 4096
+
+def pack_items(item_format, columns):
+    """ Return items packed with `item_format` made of values in
+    `columns`, sequences of equal length, one for each field. All
+    items are packed with one call.
+
+    >>> pack_items('>LQ', ([1, 2], [3, 4])) == (struct.pack('>LQ', 1, 3) +
+    ...                                         struct.pack('>LQ', 2, 4))
+    True
+
+    """
+    byte_order, fields = item_format[0], item_format[1:]
+    count = len(columns[0])
+    values = [None]*(count*len(columns))
+    for i, column in enumerate(columns):
+        values[i::len(columns)] = column
+    return struct.pack(byte_order + fields*count, *values)
+
+def copy_spans(src_map, spans, output_file):
+    """ Write (start, length) spans of memory mapped source file to
+    :class:`VolumeFile`. Adjacent spans are coalesced and copied at
+    once, up to `COPY_SLICE_SIZE` bytes at a time.
+    """
+    run_start = run_len = 0
+    for start, length in spans:
+        if (start == run_start + run_len and
+            run_len + length <= COPY_SLICE_SIZE):
+            run_len += length
+        else:
+            if run_len:
+                output_file.copy(src_map, run_start, run_len)
+            run_start, run_len = start, length
+    if run_len:
+        output_file.copy(src_map, run_start, run_len)
+
+#Maximum number of bytes read ahead of sorted order store reads
+PREFETCH_SIZE = 16*1024*1024
+#Maximum number of items read ahead
+PREFETCH_ITEMS = 65536
+
+class Prefetcher(threading.Thread):
+    """ Background thread that reads spans of a file for items ahead
+    of the consumer iterating over them, so that by the time consumer
+    gets to an item it's data is likely in page cache and reading it
+    through memory map doesn't stall on disk. Reads are kept within
+    `window` bytes ahead of the consumer.
+
+    Time consumer spends waiting for items that haven't been read
+    yet is accumulated in `stall`.
+
+    :param items: iterable of items in the order they are consumed,
+                  iterated in prefetcher thread
+    :param span: function returning (start, length) span of the file
+                 for an item
+    """
+
+    def __init__(self, file_name, items, span, window=PREFETCH_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.f = open(file_name, 'rb', 0)
+        self.items = items
+        self.span = span
+        self.window = window
+        self.cond = threading.Condition()
+        self.ready = deque()
+        self.ahead = 0
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.stall = 0.0
+
+    def run(self):
+        try:
+            for item in self.items:
+                with self.cond:
+                    while ((self.ahead > self.window or
+                            len(self.ready) >= PREFETCH_ITEMS) and
+                           not self.stopped):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                start, length = self.span(item)
+                self.f.seek(start)
+                self.f.read(length)
+                with self.cond:
+                    self.ready.append((item, length))
+                    self.ahead += length
+                    self.cond.notify()
+        except Exception, e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify()
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                with self.cond:
+                    if not self.ready and not self.done:
+                        t0 = time.time()
+                        while not self.ready and not self.done:
+                            self.cond.wait()
+                        self.stall += time.time() - t0
+                    if not self.ready:
+                        break
+                    item, length = self.ready.popleft()
+                    self.ahead -= length
+                    self.cond.notify()
+                yield item
+            if self.error:
+                raise self.error
+        finally:
+            self.stop()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.join()
+        self.f.close()
+
+#Length of article digest stored in index, used to find duplicates
+DIGEST_LENGTH = 8
+#Digest recorded for articles when store doesn't deduplicate them
+NO_DIGEST = '\0'*DIGEST_LENGTH
+
+#Store files in the order they are spread across work directories,
+#article store is the largest and gets first directory to itself if
+#there are enough of them
+STRIPED_STORE_FILES = ('.articles', '.titles', '.index', '.keys')
+#Store files that are small and read at random when compiling
+HOT_STORE_FILES = ('.titles', '.index', '.keys', '.order')
 
 class TempArticleStore(object):
+    """ Temporary storage for articles collected during conversion.
+    Titles and articles are stored prefixed with their length, packed
+    same way as in index 2 and article units of aard files, so that
+    they can be copied to output files as is.
+
+    `work_dir` may be a list of directories, store files are then
+    spread across them, sort runs are written to the first one. Small
+    store files that are read at random are placed in `hot_dir`
+    instead, if it is given.
+
+    Store keeps track of whether articles are appended in sort key
+    order, if they are sorting is skipped. If store is `presorted`,
+    sort keys are not written while articles keep coming in order,
+    they are computed from titles when sorting if order is broken.
+
+    Article digests needed by :meth:`dedup` are only calculated if
+    store is created with `dedup` set.
+    """
 
-    def __init__(self, work_dir=None):
-        fd, self.title_store_name = tempfile.mkstemp(prefix='aa-', suffix='.titles', dir=work_dir)
-        self.title_store = os.fdopen(fd, 'w')
-        fd, self.store_idx_name = tempfile.mkstemp(suffix='.index',
-                                                   prefix='aa-', 
-                                                   dir=work_dir)
-        self.store_idx = os.fdopen(fd, 'wb')
-
-        fd, self.article_store_name = tempfile.mkstemp(suffix='.articles',
-                                                        prefix='aa-', 
-                                                        dir=work_dir)
-        self.article_store = os.fdopen(fd, 'wb')
-
-        self.title_start = 0
-        self.article_start = 0
-        idx_format = '>IHQI'
+    def __init__(self, work_dir=None, sort_memory=None, sort_processes=1,
+                 state=None, prefetch_size=PREFETCH_SIZE, hot_dir=None,
+                 presorted=False, dedup=True):
+        if isinstance(work_dir, (list, tuple)):
+            self.work_dirs = list(work_dir)
+        else:
+            self.work_dirs = [work_dir]
+        self.work_dir = self.work_dirs[0]
+        self.hot_dir = hot_dir
+        self.prefetch_size = prefetch_size
+        #seconds spent waiting for store reads in sorted order
+        self.stall = 0.0
+        self.sort_memory = sort_memory
+        self.sort_processes = sort_processes
+        if state is None:
+            state = {}
+        self.title_store_name, self.title_store = self._open('.titles', state)
+        self.store_idx_name, self.store_idx = self._open('.index', state)
+        self.article_store_name, self.article_store = self._open('.articles',
+                                                                 state)
+        self.key_store_name, self.key_store = self._open('.keys', state)
+        self.presorted = presorted
+        self.digest_articles = dedup
+        #True as long as every appended article came with sort key
+        #not less than the previous one
+        self.in_order = state.get('in_order', True)
+        self.last_key = base64.b64decode(state.get('last_key', ''))
+
+        #created when sorted so that it isn't left behind
+        #by interrupted compilation
+        self.order_name = None
+
+        self.title_start = self.title_store.tell()
+        self.article_start = self.article_store.tell()
+        self.key_start = self.key_store.tell()
+        idx_format = '>IHQIQH%ds' % DIGEST_LENGTH
         self.pack = functools.partial(struct.pack, idx_format)
-        self.unpack = functools.partial(struct.unpack, idx_format)
+        self.unpack_from = struct.Struct(idx_format).unpack_from
         self.fmt_size = struct.calcsize(idx_format)
+        self.title_prefix_len = struct.calcsize(KEY_LENGTH_FORMAT)
+        self.article_prefix_len = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        self.maps = None
+        self.order_map = ''
+        self.count = self.store_idx.tell() / self.fmt_size
+        #article starts of bodies shared by several articles
+        self.shared = set()
+
+    def _open(self, suffix, state):
+        if suffix in state:
+            #reopen store file saved by checkpoint(), discarding
+            #anything written after it
+            name, length = state[suffix]
+            f = open(name, 'r+b')
+            f.truncate(length)
+            f.seek(length)
+            return name, f
+        fd, name = tempfile.mkstemp(suffix=suffix, prefix='aa-',
+                                    dir=self.file_dir(suffix))
+        return name, os.fdopen(fd, 'wb')
+
+    def file_dir(self, suffix):
+        """ Return directory for store file with `suffix`. """
+        if self.hot_dir and suffix in HOT_STORE_FILES:
+            return self.hot_dir
+        if suffix in STRIPED_STORE_FILES:
+            i = STRIPED_STORE_FILES.index(suffix)
+            return self.work_dirs[i % len(self.work_dirs)]
+        return self.work_dir
+
+    def checkpoint(self):
+        """ Flush and sync store files, return state from which store
+        can be reopened.
+        """
+        state = {}
+        for suffix, name, f in (('.titles', self.title_store_name, self.title_store),
+                                ('.index', self.store_idx_name, self.store_idx),
+                                ('.articles', self.article_store_name, self.article_store),
+                                ('.keys', self.key_store_name, self.key_store)):
+            f.flush()
+            os.fsync(f.fileno())
+            state[suffix] = (os.path.abspath(name), f.tell())
+        state['in_order'] = self.in_order
+        state['last_key'] = base64.b64encode(self.last_key)
+        return state
+
+    def append(self, title, article, sort_key=None):
+        """ Append article to the store.
+
+        :param sort_key: precomputed sort key (byte string) for title,
+                         used by :meth:`sort` instead of calling key
+                         function
+        """
+        self.append_batch(((title, article, sort_key),))
 
-    def append(self, title, article):
-        self.title_store.write(title)
-        title_len = len(title)        
-        
-        self.article_store.write(article)
-        article_len = len(article)        
-        
-        self.store_idx.write(self.pack(self.title_start, title_len, 
-                                       self.article_start, article_len))
+    def append_batch(self, batch):
+        """ Append sequence of (title, article, sort key) tuples to the
+        store, each store file is written with one call.
+        """
+        titles = []
+        articles = []
+        keys = []
+        idx = []
+        for title, article, sort_key in batch:
+            title_len = len(title)
+            titles.append(struct.pack(KEY_LENGTH_FORMAT, title_len))
+            titles.append(title)
+
+            article_len = len(article)
+            articles.append(struct.pack(ARTICLE_LENGTH_FORMAT, article_len))
+            articles.append(article)
+
+            if self.in_order:
+                if sort_key and sort_key >= self.last_key:
+                    self.last_key = sort_key
+                else:
+                    self.in_order = False
+                    if self.presorted:
+                        log.warn('Article "%s" is out of order, articles '
+                                 'will be sorted', title)
+
+            if sort_key and not (self.presorted and self.in_order):
+                keys.append(sort_key)
+                key_len = len(sort_key)
+            else:
+                key_len = 0
+
+            idx.append(self.pack(self.title_start, title_len,
+                                 self.article_start, article_len,
+                                 self.key_start, key_len,
+                                 sha1(article).digest()
+                                 if self.digest_articles else NO_DIGEST))
+
+            self.title_start += self.title_prefix_len + title_len
+            self.article_start += self.article_prefix_len + article_len
+            self.key_start += key_len
+            self.count += 1
+        self.title_store.write(''.join(titles))
+        self.article_store.write(''.join(articles))
+        if keys:
+            self.key_store.write(''.join(keys))
+        self.store_idx.write(''.join(idx))
+
+    def open(self):
+        """ Flush stores and map them for reading. """
+        if self.maps:
+            return
+        for f in (self.title_store, self.article_store,
+                  self.store_idx, self.key_store):
+            f.flush()
+        self.maps = [map_file(name) for name in (self.title_store_name,
+                                                 self.article_store_name,
+                                                 self.store_idx_name,
+                                                 self.key_store_name)]
+        self.title_map, self.article_map, self.idx_map, self.key_map = self.maps
+
+    def record(self, pos):
+        """ Return tuple of title start, title length, article start, 
+        article length, sort key start, sort key length and article
+        digest for article at position `pos` in insertion order. Title
+        and article start point to length prefix.
+        """
+        return self.unpack_from(self.idx_map, pos*self.fmt_size)
 
-        self.title_start += title_len
-        self.article_start += article_len
-        
+    def title(self, record):
+        start = record[0] + self.title_prefix_len
+        return self.title_map[start:start+record[1]]
 
-    def sorted(self, key=None):
-        """ Return generator that produces ordered (title, article) 
-        pairs sorted by title.
+    def article(self, record):
+        start = record[2] + self.article_prefix_len
+        return self.article_map[start:start+record[3]]
+
+    def article_unit(self, record):
+        """ Return length prefixed article. """
+        start = record[2]
+        return self.article_map[start:start+self.article_prefix_len+record[3]]
+
+    def title_span(self, record):
+        return record[0], self.title_prefix_len + record[1]
+
+    def article_span(self, record):
+        return record[2], self.article_prefix_len + record[3]
+
+    def prefetched(self, items, file_name, span):
+        """ Generate items while reading their spans of `file_name`
+        ahead in background thread (see :class:`Prefetcher`). If
+        store's `prefetch_size` is 0 spans are read as items are
+        generated. Time spent waiting for reads is added to `stall`.
+        """
+        if self.prefetch_size:
+            prefetcher = Prefetcher(file_name, items, span,
+                                    self.prefetch_size)
+            try:
+                for item in prefetcher:
+                    yield item
+            finally:
+                self.stall += prefetcher.stall
+            return
+        with open(file_name, 'rb', 0) as f:
+            for item in items:
+                start, length = span(item)
+                t0 = time.time()
+                f.seek(start)
+                f.read(length)
+                self.stall += time.time() - t0
+                yield item
+
+    def prefetched_articles(self, records):
+        return self.prefetched(records, self.article_store_name,
+                               self.article_span)
+
+    def sort(self, key=None):
+        """ Sort articles by title, sorted order is written to a
+        temporary file and is then available through
+        :meth:`sorted_records`.
 
         :param key: function of one argument that takes article title 
                     and returns sort key for this title, title itself is used 
-                    as key if key function is None        
+                    as key if key function is None. Not called for
+                    articles appended with precomputed sort key.
+
+        If store was created with `sort_memory` set, sort keys must be 
+        byte strings and memory used for sorting is limited to 
+        approximately this number of bytes, the rest is spilled to 
+        temporary files in store's work dir. If `sort_processes` is
+        greater than 1 sorting is done in parallel by that many worker
+        processes, sort keys must be byte strings too.
         """
-
-        self.title_store.flush()
-        self.article_store.flush()
-        self.store_idx.flush()
+        self.open()
 
         if key is None:
             key = lambda x: x
 
-        with open(self.title_store_name, 'r+') as title_store_f:
-            with open(self.article_store_name, 'r+') as article_store_f:
-                with open(self.store_idx_name, 'r+b') as store_idx_f:
-
-                    title_store = mmap.mmap(title_store_f.fileno(), 0)
-                    article_store = mmap.mmap(article_store_f.fileno(), 0)
-                    store_idx = mmap.mmap(store_idx_f.fileno(), 0)
+        def realkey(x):
+            record = self.record(x)
+            key_start, key_len = record[4:6]
+            if key_len:
+                return self.key_map[key_start:key_start+key_len]
+            return key(self.title(record))
 
-                    def index_item_at(pos):
-                        pos_start = pos*self.fmt_size
-                        pos_end = pos_start + self.fmt_size
-                        return self.unpack(store_idx[pos_start:pos_end])
+        if self.in_order:
+            log.info('Articles were added in sorted order, not sorting')
+            positions = xrange(self.count)
+        else:
+            positions = self.sort_positions(realkey)
+
+        if self.order_map:
+            self.order_map.close()
+        if self.order_name is None:
+            fd, self.order_name = tempfile.mkstemp(suffix='.order',
+                                                   prefix='aa-',
+                                                   dir=self.file_dir('.order'))
+            os.close(fd)
+        with open(self.order_name, 'wb') as f:
+            chunk = array(POSITION_FORMAT)
+            for i in positions:
+                chunk.append(i)
+                if len(chunk) == 65536:
+                    chunk.tofile(f)
+                    del chunk[:]
+            chunk.tofile(f)
+        self.order_map = map_file(self.order_name)
+
+    def sort_positions(self, key):
+        """ Return positions in insertion order ordered by `key`,
+        function of position, sorted as configured for this store (see
+        :meth:`sort`).
+        """
+        count = self.count
+        if self.sort_processes > 1:
+            return partitioned_sort(count, key,
+                                    self.sort_processes,
+                                    self.sort_memory,
+                                    self.work_dir)
+        elif self.sort_memory:
+            return external_sort(count, key,
+                                 self.sort_memory,
+                                 self.work_dir)
+        else:
+            return sorted(xrange(count), key=key)
 
+    def dedup(self):
+        """ Find articles with identical bodies and point index entries
+        of all of them at the first copy, so that it is written to
+        each volume once (see :meth:`volume_articles`). Return
+        number of duplicates and their total length.
+        """
+        self.open()
+        #empty index file isn't mapped, nothing to patch
+        if not self.count:
+            return 0, 0
+        count = 0
+        length = 0
+        #article start field offset in index entry
+        field_offset = struct.calcsize('>IH')
+        with open(self.store_idx_name, 'r+b') as idx:
+            digest = None
+            for pos in self.sort_positions(lambda pos: self.record(pos)[6]):
+                record = self.record(pos)
+                if record[6] != digest:
+                    digest = record[6]
+                    #records with same digest and different body
+                    #are very unlikely but possible
+                    originals = [record]
+                    continue
+                body = self.article(record)
+                for original in originals:
+                    if (original[3] == record[3] and
+                        self.article(original) == body):
+                        break
+                else:
+                    originals.append(record)
+                    continue
+                idx.seek(pos*self.fmt_size + field_offset)
+                idx.write(struct.pack('>Q', original[2]))
+                self.shared.add(original[2])
+                count += 1
+                length += record[3]
+        #make sure patched index is seen through the map
+        self.idx_map.close()
+        self.idx_map = self.maps[2] = map_file(self.store_idx_name)
+        return count, length
+
+    def volume_articles(self, start, end):
+        """ Generate tuples of record, article offset and flag
+        indicating whether article body is written at this offset
+        for articles from position `start` to `end` in sorted
+        order. Offset is relative to first article. Articles sharing
+        body with an article already written get it's offset.
+        """
+        written = {}
+        offset = 0
+        for record in self.sorted_records(start, end):
+            article_start = record[2]
+            if article_start in written:
+                yield record, written[article_start], False
+                continue
+            if article_start in self.shared:
+                written[article_start] = offset
+            yield record, offset, True
+            offset += self.article_prefix_len + record[3]
+
+    def sorted_records(self, start=0, end=None):
+        """ Generate records (see :meth:`record`) in sorted order,
+        from position `start` to `end` in sorted order.
+        """
+        if end is None:
+            end = self.count
+        itemsize = array(POSITION_FORMAT).itemsize
+        for chunk_start in xrange(start, end, 65536):
+            chunk_end = min(end, chunk_start + 65536)
+            positions = array(POSITION_FORMAT,
+                              self.order_map[chunk_start*itemsize:
+                                             chunk_end*itemsize])
+            for pos in positions:
+                yield self.record(pos)
 
-                    def realkey(x):
-                        index_item = index_item_at(x)
-                        title_start = index_item[0]
-                        title_len = index_item[1]
-                        title_end = title_start+title_len
-                        title = title_store[title_start:title_end]
-                        return key(title)
+    def sorted(self, key=None):
+        """ Return generator that produces ordered (title, article) 
+        pairs sorted by title (see :meth:`sort`).
+        """
+        self.sort(key)
+        for record in self.prefetched_articles(self.sorted_records()):
+            yield self.title(record), self.article(record)
 
-                    for i in sorted(xrange(len(store_idx)/self.fmt_size),
-                                    key=realkey):
-                        title_start, title_len, article_start, article_len = index_item_at(i)
-                        yield (title_store[title_start:title_start+title_len], 
-                               article_store[article_start:article_start+article_len])
+    def copy_titles(self, start, end, output_file):
+        """ Write length prefixed titles from position `start` to
+        `end` in sorted order to output file.
+        """
+        records = self.prefetched(self.sorted_records(start, end),
+                                  self.title_store_name, self.title_span)
+        copy_spans(self.title_map,
+                   (self.title_span(record) for record in records),
+                   output_file)
+
+    def copy_articles(self, start, end, output_file):
+        """ Write length prefixed articles from position `start` to
+        `end` in sorted order to output file, bodies shared by several
+        articles are written once.
+        """
+        records = (record for record, offset, new
+                   in self.volume_articles(start, end) if new)
+        copy_spans(self.article_map,
+                   (self.article_span(record)
+                    for record in self.prefetched_articles(records)),
+                   output_file)
 
     def close(self):
         self.title_store.close()
         self.article_store.close()
         self.store_idx.close()
+        self.key_store.close()
+        if self.maps:
+            for m in self.maps:
+                if m:
+                    m.close()
+            if self.order_map:
+                self.order_map.close()
         os.remove(self.title_store_name)
         os.remove(self.article_store_name)
         os.remove(self.store_idx_name)        
+        os.remove(self.key_store_name)
+        if self.order_name:
+            os.remove(self.order_name)
+
+#Maximum number of articles waiting to be written to the store
+STORE_QUEUE_SIZE = 8192
+#Maximum number of articles written to the store at once
+STORE_BATCH_SIZE = 1024
+
+class StoreWriter(threading.Thread):
+    """ Background thread appending articles to
+    :class:`TempArticleStore` in batches. Articles are queued by
+    :meth:`append` which only blocks when queue is full.
+    """
+
+    def __init__(self, store):
+        threading.Thread.__init__(self, name='StoreWriter')
+        self.daemon = True
+        self.store = store
+        self.queue = Queue(STORE_QUEUE_SIZE)
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            done = False
+            while not done:
+                batch = []
+                item = self.queue.get()
+                #None stops the thread, events mark flush points
+                while isinstance(item, tuple):
+                    batch.append(item)
+                    if len(batch) == STORE_BATCH_SIZE:
+                        item = ()
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except Empty:
+                        item = ()
+                        break
+                if batch:
+                    self.store.append_batch(batch)
+                if item is None:
+                    done = True
+                elif item:
+                    item.set()
+        except Exception, e:
+            log.exception('Failed to write articles to temporary store')
+            self.error = e
+
+    def put(self, item):
+        while True:
+            if self.error:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1.0)
+            except Full:
+                continue
+            else:
+                return
+
+    def append(self, title, article, sort_key=None):
+        self.put((title, article, sort_key))
+
+    def flush(self):
+        """ Wait until all queued articles are written to the store. """
+        marker = threading.Event()
+        self.put(marker)
+        while not marker.is_set():
+            if self.error:
+                raise self.error
+            marker.wait(1.0)
+
+    def close(self):
+        """ Write all queued articles and stop the thread. """
+        self.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+CHECKPOINT_FILE = 'checkpoint.json'
+SESSION_FILE = 'session.json'
+
+def write_checkpoint(session_dir, state):
+    """ Atomically replace checkpoint in session dir. """
+    name = os.path.join(session_dir, CHECKPOINT_FILE)
+    tmp_name = name + '.tmp'
+    with open(tmp_name, 'wb') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_name, name)
+
+def read_checkpoint(session_dir):
+    name = os.path.join(session_dir, CHECKPOINT_FILE)
+    if not os.path.exists(name):
+        return None
+    with open(name, 'rb') as f:
+        return json.load(f)
+
+class ArticleBlocks(object):
+    """ Temporary files with compressed article blocks and index 1
+    items for all volumes of format version 2, written when volumes
+    are planned (see :meth:`Compiler.plan_block_volumes`) and then
+    copied to volume files as is.
+
+    Block is stored prefixed with it's length. Uncompressed block is
+    a sequence of length prefixed articles, same as articles in
+    format version 1.
+    """
+
+    def __init__(self, block_size, policy, work_dir=None, index_dir=None):
+        self.block_size = block_size
+        self.policy = policy
+        fd, self.blocks_name = tempfile.mkstemp(prefix='aa-', suffix='.blocks',
+                                                dir=work_dir)
+        self.blocks = os.fdopen(fd, 'wb', 1024*1024)
+        fd, self.index1_name = tempfile.mkstemp(prefix='aa-', suffix='.index1',
+                                                dir=index_dir or work_dir)
+        self.index1 = os.fdopen(fd, 'wb', 1024*1024)
+        self.prefix_len = struct.calcsize(ARTICLE_LENGTH_FORMAT)
+        self.units = []
+        self.pending_len = 0
+        self.count = 0
+        self.maps = None
+
+    full = property(lambda self: self.pending_len >= self.block_size)
+
+    def add(self, unit):
+        """ Add length prefixed article to open block, return it's
+        offset in uncompressed block.
+        """
+        offset = self.pending_len
+        self.units.append(unit)
+        self.pending_len += len(unit)
+        return offset
+
+    def close_block(self):
+        """ Compress and write open block, return number of bytes
+        written.
+        """
+        if not self.units:
+            return 0
+        compressed, report = self.policy.compress(''.join(self.units))
+        record_compression(report)
+        self.policy.learn(report)
+        self.blocks.write(struct.pack(ARTICLE_LENGTH_FORMAT, len(compressed)))
+        self.blocks.write(compressed)
+        self.units = []
+        self.pending_len = 0
+        self.count += 1
+        return self.prefix_len + len(compressed)
+
+    def open(self):
+        """ Flush files and map them for copying. """
+        self.blocks.close()
+        self.index1.close()
+        self.blocks = open(self.blocks_name, 'rb')
+        self.index1 = open(self.index1_name, 'rb')
+        self.maps = [map_file(self.blocks_name), map_file(self.index1_name)]
+        self.blocks_map, self.index1_map = self.maps
+
+    def close(self):
+        if self.maps:
+            for m in self.maps:
+                if m:
+                    m.close()
+        self.blocks.close()
+        self.index1.close()
+        os.remove(self.blocks_name)
+        os.remove(self.index1_name)
 
 class Compiler(object):
 
-    def __init__(self, output_file_name, max_file_size, session_dir, metadata=None):
+    def __init__(self, output_file_name, max_file_size, session_dir,
+                 metadata=None, sort_memory=None, sort_processes=1,
+                 compress_threads=0, checkpoint_interval=0, resume=None,
+                 dedup=True, block_size=0, block_compression='best',
+                 prefetch_size=PREFETCH_SIZE, volume_processes=1,
+                 work_dirs=None, hot_dir=None, presorted=False):
         self.uuid = uuid.uuid4()
         self.output_file_name = output_file_name
         self.max_file_size = max_file_size
         self.index_count = 0
         self.session_dir = session_dir
-        self.failed_articles = open(os.path.join(self.session_dir, "failed.txt"), 'w')
-        self.empty_articles = open(os.path.join(self.session_dir, "empty.txt"), 'w')
-        self.skipped_articles = open(os.path.join(self.session_dir, "skipped.txt"), 'w')
+        #directories for temporary files, session dir if not given
+        self.work_dirs = work_dirs or [session_dir]
+        self.hot_dir = hot_dir
+        self.failed_articles = self.open_list("failed.txt", resume)
+        self.empty_articles = self.open_list("empty.txt", resume)
+        self.skipped_articles = self.open_list("skipped.txt", resume)
+        self.timedout_articles = self.open_list("timedout.txt", resume)
         self.metadata = metadata if metadata is not None else {}
         self.file_names = []
         self.stats = Stats()
         self.last_stat_update = 0
-        self.article_store = TempArticleStore(self.session_dir)
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        #index of input file articles are being collected from,
+        #saved in checkpoint along with position in that file
+        self.input_index = resume.get('input', 0) if resume else 0
+        self.dedup = dedup
+        self.volume_processes = volume_processes
+        #format version 2 if articles are packed into blocks
+        self.block_size = block_size
+        if block_size:
+            self.format_version = 2
+            self.block_policy = compression_policies[block_compression]()
+        else:
+            self.format_version = 1
+            self.block_policy = None
+        self.article_blocks = None
+        if resume:
+            self.stats.restore(resume['stats'])
+            for name, values in resume['compression'].iteritems():
+                vars(compress_counts[name]).update(values)
+            compression_policy.restore(resume.get('compression_policy'))
+            store_state = resume['store']
+        else:
+            store_state = None
+        self.article_store = TempArticleStore(self.work_dirs, sort_memory,
+                                              sort_processes, store_state,
+                                              prefetch_size, hot_dir,
+                                              presorted, dedup)
+        self.store_writer = StoreWriter(self.article_store)
+        #Articles submitted for compression to thread pool,
+        #stored in submission order as compression results are
+        #collected
+        self.pending = deque()
+        if compress_threads:
+            log.info('Compressing articles in %d threads', compress_threads)
+            self.compress_pool = ThreadPool(compress_threads)
+            self.max_pending = compress_threads*COMPRESS_QUEUE_SIZE
+        else:
+            self.compress_pool = None
         log.info('Collecting articles')
 
+    def open_list(self, name, resume=None):
+        path = os.path.join(self.session_dir, name)
+        if resume and name in resume['lists']:
+            f = open(path, 'r+')
+            f.truncate(resume['lists'][name])
+            f.seek(0, os.SEEK_END)
+            return f
+        return open(path, 'w')
+
+    def close_lists(self):
+        """ Close lists of articles that weren't added. """
+        for f in (self.failed_articles, self.empty_articles,
+                  self.skipped_articles, self.timedout_articles):
+            f.close()
+
+    def checkpoint(self, position):
+        """ Save state of collected articles to session dir
+        if checkpoint interval has passed since last checkpoint, so
+        that compilation can be resumed with :option:`--resume`.
+        `position` is the number of articles processed so far in
+        input file :attr:`input_index`, all articles before it and
+        all articles of preceding input files must have been added
+        already.
+        """
+        t = time.time()
+        if (not self.checkpoint_interval or
+            t - self.last_checkpoint < self.checkpoint_interval):
+            return
+        with article_add_lock:
+            if self.compress_pool:
+                self.collect_compressed()
+            self.store_writer.flush()
+            lists = {}
+            for f in (self.failed_articles, self.empty_articles,
+                      self.skipped_articles, self.timedout_articles):
+                f.flush()
+                os.fsync(f.fileno())
+                lists[os.path.basename(f.name)] = f.tell()
+            state = dict(input=self.input_index,
+                         position=position,
+                         store=self.article_store.checkpoint(),
+                         lists=lists,
+                         stats=self.stats.checkpoint(),
+                         compression=dict((name, vars(stats))
+                                          for name, stats
+                                          in compress_counts.iteritems()),
+                         compression_policy=compression_policy.state())
+            write_checkpoint(self.session_dir, state)
+        self.last_checkpoint = time.time()
+        log.info('Checkpoint at article %d of input %d written in %.1fs',
+                 position, self.input_index, self.last_checkpoint - t)
+
     def add_metadata(self, key, value):
         if key not in self.metadata:
             self.metadata[key] = value
@@ -449,17 +1702,97 @@ class Compiler(object):
                      key, value)
 
     @utf8
-    def add_article(self, title, serialized_article, redirect=False, count=True, size=0):
+    def add_article(self, title, serialized_article, redirect=False, count=True,
+                    size=0, sort_key=None):
+        if redirect and title and serialized_article:
+            self.store_redirect(title, serialized_article, count,
+                                size, sort_key, time.time())
+            return
+        if title and serialized_article:
+            if self.compress_pool:
+                with article_add_lock:
+                    result = self.compress_pool.apply_async(compress_with_codec,
+                                                            (serialized_article,))
+                    self.pending.append((result, title, redirect,
+                                         count, size, sort_key))
+                    self.collect_compressed(self.max_pending)
+                return
+            serialized_article = compress(serialized_article)
+        self.add_compressed_article(title, serialized_article, redirect,
+                                    count, size, sort_key)
+
+    @utf8
+    def add_redirect(self, title, target, count=True, size=0, sort_key=None):
+        """ Add redirect article pointing to `target` title. """
+        t0 = time.time()
+        self.store_redirect(title, redirect_stub(target), count,
+                            size, sort_key, t0)
+
+    def store_redirect(self, title, serialized_redirect, count,
+                       size, sort_key, t0):
+        """ Store serialized redirect as is: redirects are too short to
+        get any smaller when compressed and readers keep data as is if
+        it can't be decompressed.
+        """
+        with article_add_lock:
+            if self.pending:
+                #articles before it are still being compressed
+                self.pending.append((DoneResult((serialized_redirect, None)),
+                                     title, True, count, size, sort_key))
+                self.collect_compressed(self.max_pending)
+            else:
+                self.store_article(title, serialized_redirect, True,
+                                   count, size, sort_key, None)
+            self.stats.redirect_stubs += 1
+            self.stats.redirect_time += time.time() - t0
+
+    @utf8
+    def add_compressed_article(self, title, compressed_article, redirect=False,
+                               count=True, size=0, sort_key=None, report=None):
+        """ Add article already compressed with
+        :func:`compress_with_codec` (for example in a worker process).
+
+        :param report: compression report returned by
+                       :func:`compress_with_codec`, added to
+                       compression statistics
+        """
+        with article_add_lock:
+            self.collect_compressed()
+            self.store_article(title, compressed_article, redirect,
+                               count, size, sort_key, report)
+
+    def collect_compressed(self, max_pending=0):
+        """ Store articles compressed in thread pool in submission 
+        order, waiting for compression to finish, until no more than 
+        `max_pending` articles are left in compression queue.
+        """
+        with article_add_lock:
+            while len(self.pending) > max_pending:
+                (result, title, redirect,
+                 count, size, sort_key) = self.pending.popleft()
+                compressed_article, report = result.get()
+                self.store_article(title, compressed_article, redirect,
+                                   count, size, sort_key, report)
+
+    def store_article(self, title, compressed_article, redirect,
+                      count, size, sort_key, report):
         with article_add_lock:
             if not title:
                 log.warn('Blank title, ignoring article "%s"',
-                         serialized_article)
+                         compressed_article)
                 return
-            if not serialized_article:
+            if not compressed_article:
                 self.empty_article(title)
                 return
             log.debug('Adding article for "%s"', title)
-            self.article_store.append(title, compress(serialized_article))
+            if report:
+                record_compression(report)
+                compression_policy.learn(report)
+            if not redirect:
+                compression_policy.observe(compressed_article)
+            if sort_key is None:
+                sort_key = sortkey(title)
+            self.store_writer.append(title, compressed_article, sort_key)
             if count:
                 if not redirect:
                     self.stats.articles += 1
@@ -486,8 +1819,15 @@ class Compiler(object):
         self.skipped_articles.write(title+'\n')
         self.print_stats()
 
-    def timedout(self, count=1):
-        self.stats.timedout += count
+    @utf8
+    def recovered(self, title):
+        self.stats.recovered += 1
+        log.info('Converted "%s" on retry', title)
+
+    @utf8
+    def timedout(self, title):
+        self.stats.timedout += 1
+        self.timedout_articles.write(title+'\n')
         self.print_stats()
 
     def print_stats(self):
@@ -497,75 +1837,205 @@ class Compiler(object):
             print_progress(self.stats)
 
     def compile(self):
+        if self.compress_pool:
+            self.collect_compressed()
+            self.compress_pool.close()
+            self.compress_pool.join()
+        self.store_writer.close()
         print_progress(self.stats)
         writeln()
-        self.failed_articles.close()
-        self.empty_articles.close()
-        self.skipped_articles.close()
+        self.close_lists()
         writeln('Compiling .aar files')
         self.add_metadata("article_count", self.stats.articles)
-        articles = self.article_store.sorted(key=lambda x:
-                                                 collation_key(x).getByteArray())
+        if self.dedup:
+            log.info('Looking for duplicate articles')
+            count, length = self.article_store.dedup()
+            log.info('Found %d duplicate articles (%s)',
+                     count, sizeof_fmt(length))
+        log.info('Sorting articles')
+        self.article_store.sort(key=sortkey)
+        if self.block_policy:
+            self.train_block_policy()
         log.info('Compiling %s', self.output_file_name)
-        metadata = compress(tojson(self.metadata).encode('utf8'))
-        header_meta_len = spec_len(HEADER_SPEC) + len(metadata)
-        create_volume_func = functools.partial(self.create_volume,
-                                               header_meta_len)
-        for volume in self.make_volumes(create_volume_func, articles):
-            m = "Creating volume %d" % volume.number
-            log.info(m)
-            writeln(m).flush()
-            file_name = self.make_aar(volume)
-            self.file_names.append(file_name)
-            m = "Wrote volume %d" % volume.number
-            log.info(m)
-            writeln(m).flush()
+        policy = self.block_policy or compression_policy
+        for key, value in policy.metadata().iteritems():
+            self.add_metadata(key, value)
+        if (self.format_version == 1 and
+            'compression_dictionary' in self.metadata):
+            self.format_version = DICTIONARY_FORMAT_VERSION
+            log.info('Articles compressed with preset dictionary, '
+                     'writing format version %d', self.format_version)
+        metadata = tojson(self.metadata).encode('utf8')
+        #metadata must be readable without preset dictionary
+        self.compressed_metadata = CompressionPolicy(policy.codecs).compress(metadata)[0]
+        header_meta_len = spec_len(HEADER_SPEC) + len(self.compressed_metadata)
+        if self.block_size:
+            volumes = self.plan_block_volumes(header_meta_len)
+        else:
+            volumes = self.plan_volumes(header_meta_len)
+        self.file_names.extend(self.write_volumes(volumes))
+        log.info('Waited %.1fs for article store reads',
+                 self.article_store.stall)
+        if self.article_blocks:
+            self.article_blocks.close()
         self.article_store.close()
-        self.write_volume_count()
-        self.write_sha1sum()
         rename_files(self.file_names)
 
-    def create_volume(self, header_meta_len):
-        return Volume(header_meta_len, self.max_file_size, self.session_dir)
-
-    def make_volumes(self, create_volume_func, articles):
-        volume = create_volume_func()
-        for title, serialized_article in articles:
-            index1Unit = struct.pack(INDEX1_ITEM_FORMAT,
-                                     volume.index2Length,
-                                     volume.articles_len)
-            index2Unit = struct.pack(KEY_LENGTH_FORMAT, len(title)) + title
-            article_unit = (struct.pack(ARTICLE_LENGTH_FORMAT,
-                                       len(serialized_article)) +
-                            serialized_article)
+    def write_volume(self, volume, total_volumes):
+        m = "Creating volume %d" % volume.number
+        log.info(m)
+        writeln(m).flush()
+        file_name = self.make_aar(volume, total_volumes)
+        m = "Wrote volume %d" % volume.number
+        log.info(m)
+        writeln(m).flush()
+        return file_name
+
+    def write_volumes(self, volumes):
+        """ Write planned volumes, return list of file names. Volumes
+        are independent once planned, so if more than one
+        `volume_processes` is configured they are written in
+        parallel by a pool of worker processes.
+        """
+        processes = min(self.volume_processes, len(volumes))
+        if processes < 2:
+            return [self.write_volume(volume, len(volumes))
+                    for volume in volumes]
+        global volume_compiler
+        log.info('Writing %d volumes in %d processes',
+                 len(volumes), processes)
+        volume_compiler = self
+        pool = Pool(processes=processes)
+        try:
+            results = pool.map(write_volume,
+                               [(volume, len(volumes)) for volume in volumes],
+                               chunksize=1)
+        finally:
+            pool.terminate()
+            volume_compiler = None
+        file_names = []
+        for file_name, stall in results:
+            file_names.append(file_name)
+            self.article_store.stall += stall
+        return file_names
+
+    def create_volume(self, header_meta_len, first=0):
+        return Volume(header_meta_len, self.max_file_size, first)
+
+    def plan_volumes(self, header_meta_len):
+        """ Return list of volumes covering all articles in sorted
+        order, each fitting into maximum file size.
+        """
+        volumes = []
+        volume = self.create_volume(header_meta_len)
+        shared = self.article_store.shared
+        written = set()
+        for i, record in enumerate(self.article_store.sorted_records()):
+            title_len, article_start, article_len = record[1:4]
             try:
-                volume.add(index1Unit, index2Unit, article_unit)
+                volume.add(title_len, article_len, article_start in written)
             except Volume.ExceedsMaxSize:
-                volume.flush()
-                yield volume
-                volume = create_volume_func()
-                index1Unit = struct.pack(INDEX1_ITEM_FORMAT,
-                                         volume.index2Length,
-                                         volume.articles_len)
-                volume.add(index1Unit, index2Unit, article_unit)
-        volume.flush()
-        yield volume
+                volumes.append(volume)
+                volume = self.create_volume(header_meta_len, i)
+                written.clear()
+                volume.add(title_len, article_len)
+            if article_start in shared:
+                written.add(article_start)
+        volumes.append(volume)
+        log.info('Planned %d volume(s)', len(volumes))
+        return volumes
+
+    def train_block_policy(self):
+        """ Let block compression policy observe stored articles before
+        blocks are packed, so that metadata it needs (preset
+        dictionary) is known before volumes are planned.
+        """
+        store = self.article_store
+        for pos in xrange(store.count):
+            if not self.block_policy.needs_samples:
+                break
+            self.block_policy.observe(store.article(store.record(pos)))
+
+    def plan_block_volumes(self, header_meta_len):
+        """ Return list of volumes for format version 2. Articles are
+        packed into blocks as volumes are planned, so that volume size
+        accounts for actual compressed block sizes. Open block never
+        grows beyond it's uncompressed length, which is used to check
+        whether next article still fits into the volume.
+        """
+        store = self.article_store
+        #blocks are written while article store is read, last work
+        #dir is the one least likely to hold article store
+        blocks = self.article_blocks = ArticleBlocks(self.block_size,
+                                                     self.block_policy,
+                                                     self.work_dirs[-1],
+                                                     self.hot_dir)
+        key_length_len = struct.calcsize(KEY_LENGTH_FORMAT)
+        volumes = []
+        volume = self.create_block_volume(header_meta_len)
+        #locations of shared bodies already added to this volume
+        written = {}
+        records = store.prefetched_articles(store.sorted_records())
+        for i, record in enumerate(records):
+            title_len, article_start, article_len = record[1:4]
+            location = written.get(article_start)
+            while True:
+                unit_len = 0 if location else store.article_prefix_len + article_len
+                try:
+                    volume.add(title_len, (blocks.prefix_len +
+                                           blocks.pending_len + unit_len))
+                    break
+                except Volume.ExceedsMaxSize:
+                    if blocks.units:
+                        volume.add_block(blocks.close_block())
+                    elif volume.index_count:
+                        volumes.append(volume)
+                        volume = self.create_block_volume(header_meta_len, i)
+                        written.clear()
+                        location = None
+                    else:
+                        raise
+            if not location:
+                location = (volume.articles_len,
+                            blocks.add(store.article_unit(record)))
+                if article_start in store.shared:
+                    written[article_start] = location
+            index2ptr = volume.index2Length - key_length_len - title_len
+            blocks.index1.write(struct.pack(INDEX1_BLOCK_ITEM_FORMAT,
+                                            index2ptr, *location))
+            if blocks.full:
+                volume.add_block(blocks.close_block())
+        volume.add_block(blocks.close_block())
+        volumes.append(volume)
+        blocks.open()
+        log.info('Planned %d volume(s), packed articles into %d blocks',
+                 len(volumes), blocks.count)
+        return volumes
+
+    def create_block_volume(self, header_meta_len, first=0):
+        blocks = self.article_blocks
+        return BlockVolume(header_meta_len, self.max_file_size, first,
+                           blocks.blocks.tell(), blocks.index1.tell())
 
     def write_header(self, output_file, meta_length, index1Length,
-                     index2Length, index_count, volume):
+                     index2Length, index_count, volume, total_volumes):
         article_offset = (spec_len(HEADER_SPEC) + meta_length +
                           index1Length + index2Length)
+        if self.block_size:
+            index1_item_format = INDEX1_BLOCK_ITEM_FORMAT
+        else:
+            index1_item_format = INDEX1_ITEM_FORMAT
         values = dict(signature='aard',
                       sha1sum='0'*40,
-                      version=1,
+                      version=self.format_version,
                       uuid=self.uuid.bytes,
                       volume=volume,
-                      of=0,
-                      total_volumes=0,
+                      of=total_volumes,
+                      total_volumes=total_volumes,
                       meta_length=meta_length,
                       index_count=index_count,
                       article_offset=article_offset,
-                      index1_item_format=INDEX1_ITEM_FORMAT,
+                      index1_item_format=index1_item_format,
                       key_length_format=KEY_LENGTH_FORMAT,
                       article_length_format=ARTICLE_LENGTH_FORMAT)
         for name, fmt in HEADER_SPEC:
@@ -574,97 +2044,77 @@ class Compiler(object):
     def write_meta(self, output_file, metadata):
         output_file.write(metadata)
 
-    def write_index1(self, output_file, index1):
+    def write_index1(self, output_file, volume):
         log.debug('Writing index 1')
-        index1.seek(0)
-        count = 0
+        if self.article_blocks:
+            blocks = self.article_blocks
+            output_file.copy(blocks.index1_map,
+                             volume.index1_start, volume.index1Length)
+            return
+        key_length_len = struct.calcsize(KEY_LENGTH_FORMAT)
+        index2ptr = 0
+        items = self.article_store.volume_articles(volume.first, volume.end)
         while True:
-            unit = index1.read(struct.calcsize(INDEX1_ITEM_FORMAT))
-            if len(unit) == 0:
+            block = list(islice(items, INDEX_BLOCK_ITEMS))
+            if not block:
                 break
-            index2ptr, offset = struct.unpack(INDEX1_ITEM_FORMAT, unit)
-            unit = struct.pack(INDEX1_ITEM_FORMAT, index2ptr, offset)
-            output_file.write(unit)
-            count += 1
-        log.debug('Wrote %d items to index 1', count)
-        index1.close()
-
-    def write_index2(self, output_file, index2):
+            index2ptrs = []
+            offsets = []
+            for record, offset, new in block:
+                index2ptrs.append(index2ptr)
+                offsets.append(offset)
+                index2ptr += key_length_len + record[1]
+            output_file.write(pack_items(INDEX1_ITEM_FORMAT,
+                                         (index2ptrs, offsets)))
+        log.debug('Wrote %d items to index 1', volume.index_count)
+
+    def write_index2(self, output_file, volume):
         log.debug('Writing index 2')
-        index2.seek(0)
-        count = 0
-        while True:
-            unitLengthString = index2.read(struct.calcsize(KEY_LENGTH_FORMAT))
-            if len(unitLengthString) == 0:
-                break
-            count += 1
-            unitLength, = struct.unpack(KEY_LENGTH_FORMAT, unitLengthString)
-            unit = index2.read(unitLength)
-            output_file.write(unitLengthString + unit)
-        log.debug('Wrote %d items to index 2', count)
-        index2.close()
-
-    def write_articles(self, output_file, articles):
-        articles.seek(0)
-        count = 0
-        while True:
-            unitLengthString = articles.read(struct.
-                                             calcsize(ARTICLE_LENGTH_FORMAT))
-            if len(unitLengthString) == 0:
-                break
-            count += 1
-            unitLength, = struct.unpack(ARTICLE_LENGTH_FORMAT,
-                                        unitLengthString)
-            unit = articles.read(unitLength)
-            output_file.write(unitLengthString + unit)
-        log.debug('Wrote %d items to articles', count)
-        articles.close()
-
-    def write_sha1sum(self):
-        for file_name in self.file_names:
-            msg = "Calculating checksum for %s" % file_name
-            log.info(msg)
-            offset = spec_len(HEADER_SPEC[:2])
-            st_size = os.stat(file_name).st_size
-            size = float(st_size - offset)
-            for pos, sha1sum in calcsha1(file_name, offset):
-                (display.erase_line().cr()
-                .write(msg).write(': ').write('%.1f%%' % (100*pos/size)))
-            sha1sum = sha1sum.hexdigest()
-            msg = "%s sha1: %s" % (file_name, sha1sum)
-            log.info(msg)
-            display.erase_line().cr().writeln(msg)
-            output_file = open(file_name, "r+b")
-            output_file.seek(spec_len(HEADER_SPEC[:1]))
-            output_file.write(sha1sum)
-            output_file.close()
-
-    def make_aar(self, volume):
-        (index1, index1Length, index2, index2Length, articles,
-         articles_len, index_count) = volume.totuple()
-        file_name = '%s.%d' % (self.output_file_name, Volume.number)
-        output_file = open(file_name, "wb", 8192)
-        metadata = compress(tojson(self.metadata).encode('utf8'))
-        self.write_header(output_file, len(metadata), index1Length,
-                          index2Length, index_count, Volume.number)
+        self.article_store.copy_titles(volume.first, volume.end, output_file)
+        log.debug('Wrote %d items to index 2', volume.index_count)
+
+    def write_articles(self, output_file, volume):
+        if self.article_blocks:
+            blocks = self.article_blocks
+            output_file.copy(blocks.blocks_map,
+                             volume.blocks_start, volume.articles_len)
+            return
+        self.article_store.copy_articles(volume.first, volume.end,
+                                         output_file)
+        log.debug('Wrote %d items to articles', volume.index_count)
+
+    def make_aar(self, volume, total_volumes):
+        file_name = '%s.%d' % (self.output_file_name, volume.number)
+        output_file = VolumeFile(file_name)
+        metadata = self.compressed_metadata
+        self.write_header(output_file, len(metadata), volume.index1Length,
+                          volume.index2Length, volume.index_count,
+                          volume.number, total_volumes)
         self.write_meta(output_file, metadata)
-        self.write_index1(output_file, index1)
-        self.write_index2(output_file, index2)
-        self.write_articles(output_file, articles)
-        output_file.close()
+        self.write_index1(output_file, volume)
+        self.write_index2(output_file, volume)
+        self.write_articles(output_file, volume)
+        sha1sum = output_file.close()
+        msg = "%s sha1: %s" % (file_name, sha1sum)
+        log.info(msg)
+        display.erase_line().cr().writeln(msg)
         log.info("Done with %s", file_name)
         return file_name
 
-    def write_volume_count(self):
-        name, fmt = HEADER_SPEC[5]
-        log.info("Writing volume count %d to all volumes as %s",
-                 Volume.number, fmt)
-        log.debug('Writing' )
-        for file_name in self.file_names:
-            output_file = open(file_name, "r+b")
-            output_file.seek(spec_len(HEADER_SPEC[:5]))
-            output_file.write(struct.pack(fmt, Volume.number))
-            output_file.close()
+#Compiler whose volumes are written by worker processes, inherited
+#by workers when pool is started
+volume_compiler = None
+
+def write_volume(args):
+    """ Write volume in worker process (see
+    :meth:`Compiler.write_volumes`), return file name and time spent
+    waiting for article store reads.
+    """
+    volume, total_volumes = args
+    store = volume_compiler.article_store
+    stall = store.stall
+    file_name = volume_compiler.write_volume(volume, total_volumes)
+    return file_name, store.stall - stall
 
 def rename_files(file_names):
     """
@@ -719,6 +2169,8 @@ def rename_file(file_name, newname_pattern, args):
 
 import zlib
 import bz2
+import base64
+from aardtools import zdict
 
 def _zlib(s):
     return zlib.compress(s)
@@ -726,21 +2178,277 @@ def _zlib(s):
 def _bz2(s):
     return bz2.compress(s)
 
+class CodecStats(object):
+
+    def __init__(self):
+        #number of articles stored compressed with this codec
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        #time spent in this codec, including attempts
+        #that didn't produce the smallest result
+        self.seconds = 0.0
+
+    saved = property(lambda self: self.bytes_in - self.bytes_out)
+
+    def __str__(self):
+        return ('%d, saved %s in %.1fs' %
+                (self.count, sizeof_fmt(self.saved), self.seconds))
+
 from collections import defaultdict
-compress_counts = defaultdict(int)
+compress_counts = defaultdict(CodecStats)
+
+def record_compression(report):
+    """ Add compression report produced by :func:`compress_with_codec`
+    to compression statistics.
+    """
+    codec, bytes_in, bytes_out, attempts = report
+    stats = compress_counts[codec]
+    stats.count += 1
+    stats.bytes_in += bytes_in
+    stats.bytes_out += bytes_out
+    for name, seconds, length in attempts:
+        compress_counts[name].seconds += seconds
+
+class CompressionPolicy(object):
+    """ Compress text with each of the codecs and keep the smallest
+    result.
+
+    >>> p = CompressionPolicy((_zlib,))
+    >>> compressed, report = p.compress('abc'*100)
+    >>> report[:3]
+    ('_zlib', 300, 15)
+    >>> p.compress('abc')[1][:3]
+    ('none', 3, 3)
+
+    """
+
+    def __init__(self, codecs=(_zlib, _bz2)):
+        self.codecs = codecs
+
+    def candidates(self, size):
+        return self.codecs
+
+    def learn(self, report):
+        """ Called with compression report of each article as it is
+        stored, in the process that stores articles.
+        """
+        pass
+
+    #True if policy wants to observe more articles before it
+    #compresses them as well as it can
+    needs_samples = False
+
+    def observe(self, compressed):
+        """ Called with each compressed article as it is stored. """
+        pass
+
+    def metadata(self):
+        """ Return dictionary metadata needed to decompress articles. """
+        return {}
+
+    def state(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+    def compress(self, text):
+        compressed = text
+        chosen = 'none'
+        attempts = []
+        for func in self.candidates(len(text)):
+            t0 = time.time()
+            c = func(text)
+            attempts.append((func.__name__, time.time() - t0, len(c)))
+            if len(c) < len(compressed):
+                compressed = c
+                chosen = func.__name__
+        return compressed, (chosen, len(text), len(compressed),
+                            tuple(attempts))
+
+#Number of articles in each size class compressed with all codecs
+#before adaptive policy commits to one
+ADAPTIVE_SAMPLE_SIZE = 200
+#Minimum fraction of bytes slower codec must save to be chosen
+ADAPTIVE_MIN_GAIN = 0.05
+
+class AdaptiveCompressionPolicy(CompressionPolicy):
+    """ Try all codecs for the first `sample_size` articles of each
+    size class (sizes between consecutive powers of 2), then commit
+    to the fastest codec for that class, unless another codec
+    produced at least `min_gain` fewer bytes.
+
+    Policy learns from compression reports of stored articles, so
+    articles compressed in worker processes are sampled too. Workers
+    don't learn themselves, they use codecs chosen by the time they
+    were started.
+    """
+
+    def __init__(self, codecs=(_zlib, _bz2),
+                 sample_size=ADAPTIVE_SAMPLE_SIZE,
+                 min_gain=ADAPTIVE_MIN_GAIN):
+        CompressionPolicy.__init__(self, codecs)
+        self.sample_size = sample_size
+        self.min_gain = min_gain
+        self.sampled = defaultdict(int)
+        #size class -> codec name -> [bytes out, seconds]
+        self.samples = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+        self.chosen = {}
+        self.lock = threading.Lock()
+
+    def size_class(self, size):
+        return int(math_log(size, 2)) if size > 1 else 0
+
+    def candidates(self, size):
+        return self.chosen.get(self.size_class(size), self.codecs)
+
+    def learn(self, report):
+        size_class = self.size_class(report[1])
+        with self.lock:
+            if size_class in self.chosen:
+                return
+            samples = self.samples[size_class]
+            for name, seconds, compressed_len in report[3]:
+                samples[name][0] += compressed_len
+                samples[name][1] += seconds
+            self.sampled[size_class] += 1
+            if self.sampled[size_class] >= self.sample_size:
+                self.commit(size_class)
+
+    def commit(self, size_class):
+        """ Choose codec for size class. Must be called with
+        `lock` held.
+        """
+        samples = self.samples.pop(size_class, None)
+        if not samples or size_class in self.chosen:
+            return
+        codecs = dict((func.__name__, func) for func in self.codecs)
+        fastest = min(samples, key=lambda name: samples[name][1])
+        chosen = fastest
+        others = [name for name in samples if name != fastest]
+        if others:
+            smallest = min(others, key=lambda name: samples[name][0])
+            fastest_bytes, fastest_seconds = samples[fastest]
+            smallest_bytes, smallest_seconds = samples[smallest]
+            gain = (float(fastest_bytes - smallest_bytes)/fastest_bytes
+                    if fastest_bytes else 0)
+            if gain >= self.min_gain:
+                chosen = smallest
+            log.info('Articles of %s - %s: using %s; %d sampled articles '
+                     'compressed to %s in %.2fs with %s, to %s in %.2fs '
+                     'with %s (%.1f%% saved)',
+                     sizeof_fmt(2**size_class), sizeof_fmt(2**(size_class+1)),
+                     chosen, self.sampled[size_class],
+                     sizeof_fmt(fastest_bytes), fastest_seconds, fastest,
+                     sizeof_fmt(smallest_bytes), smallest_seconds, smallest,
+                     100*gain)
+        self.chosen[size_class] = (codecs[chosen],)
+
+#Number of articles used to train preset dictionary
+DICTIONARY_SAMPLE_SIZE = 1000
+
+class DictionaryCompressionPolicy(CompressionPolicy):
+    """ Compress text with each of the codecs and, once preset
+    dictionary is trained on the first `sample_size` stored articles,
+    with zlib primed with the dictionary (see :mod:`aardtools.zdict`),
+    keep the smallest result.
+
+    Compressed dictionary is stored in metadata, articles compressed
+    with it can't be read by viewers that don't support it.
+
+    Worker processes inherit trained dictionary from the process that
+    stores articles when they are started, dictionary is never trained
+    in workers. Policy compressing article blocks of format version 2
+    is trained on stored articles before blocks are packed.
+    """
+
+    def __init__(self, codecs=(_zlib, _bz2),
+                 sample_size=DICTIONARY_SAMPLE_SIZE):
+        CompressionPolicy.__init__(self, codecs)
+        self.sample_size = sample_size
+        self.samples = []
+        self.compressor = None
+
+    needs_samples = property(lambda self: self.compressor is None)
+
+    def candidates(self, size):
+        if self.compressor:
+            return self.codecs + (self.zdict,)
+        return self.codecs
+
+    def zdict(self, text):
+        return self.compressor.compress(text)
+
+    def observe(self, compressed):
+        if self.compressor:
+            return
+        self.samples.append(decompress(compressed))
+        if len(self.samples) >= self.sample_size:
+            dictionary = zdict.train(self.samples)
+            log.info('Trained %s compression dictionary on %d articles',
+                     sizeof_fmt(len(dictionary)), len(self.samples))
+            self.compressor = zdict.Compressor(dictionary)
+            self.samples = []
+
+    def metadata(self):
+        if self.compressor:
+            return {'compression_dictionary':
+                    base64.b64encode(self.compressor.prefix)}
+        return {}
+
+    def state(self):
+        if self.compressor:
+            return base64.b64encode(self.compressor.dictionary)
+
+    def restore(self, state):
+        if state:
+            self.compressor = zdict.Compressor(base64.b64decode(state))
+
+compression_policies = {
+    'none': functools.partial(CompressionPolicy, ()),
+    'best': CompressionPolicy,
+    'zlib': functools.partial(CompressionPolicy, (_zlib,)),
+    'bz2': functools.partial(CompressionPolicy, (_bz2,)),
+    'adaptive': AdaptiveCompressionPolicy,
+    'zdict': DictionaryCompressionPolicy,
+    }
+
+compression_policy = CompressionPolicy()
+
+def set_compression_policy(name):
+    global compression_policy
+    compression_policy = compression_policies[name]()
+
+def compress_with_codec(text):
+    """ Return tuple of compressed text and compression report: 
+    name of compression function that produced it ('none' if text 
+    is left as is because it can't be compressed), input length, 
+    output length and tuple of (codec name, seconds, output length)
+    for each tried codec.
+    """
+    return compression_policy.compress(text)
+
+REDIRECT_STUB = '["", [], {"r": %s}]'
+
+def redirect_stub(target):
+    """ Return serialized redirect article, same as UTF-8 encoded 
+    tojson(('', [], {'r': target})).
+
+    >>> redirect_stub(u'abc')
+    '["", [], {"r": "abc"}]'
+    >>> redirect_stub('\xd0\xb0\xd0\xb1"') == tojson(('', [], {u'r': '\xd0\xb0\xd0\xb1"'.decode('utf8')})).encode('utf8')
+    True
+
+    """
+    if isinstance(target, str):
+        target = target.decode('utf8')
+    return (REDIRECT_STUB % tojson(target)).encode('utf8')
 
 def compress(text):
-    compressed = text
-    cfunc = None
-    for func in (_zlib, _bz2):
-        c = func(text)
-        if len(c) < len(compressed):
-            compressed = c
-            cfunc = func
-    if cfunc:
-        compress_counts[cfunc.__name__] += 1
-    else:
-        compress_counts['none'] += 1
+    compressed, report = compress_with_codec(text)
+    record_compression(report)
+    compression_policy.learn(report)
     return compressed
 
 
@@ -748,6 +2456,12 @@ collator = Collator.createInstance(Locale(''))
 collator.setStrength(Collator.QUATERNARY)
 collation_key = collator.getCollationKey
 
+def sortkey(title):
+    """ Return collation sort key for title as byte string """
+    if isinstance(title, unicode):
+        title = title.encode('utf8')
+    return collation_key(title).getByteArray()
+
 
 def make_output_file_name(input_file, options):
     """
@@ -812,7 +2526,7 @@ def parse_size(s):
     if s.endswith('M'):
         return int(s.strip('M'))*1024*1024
     elif s.endswith('G'):
-        return int(s.strip('G'))**1024*1024*1024
+        return int(s.strip('G'))*1024*1024*1024
     elif s.endswith('K'):
         return int(s.strip('K'))*1024
     elif s.endswith('m'):
@@ -887,7 +2601,7 @@ def print_legend():
     .ok('r').writeln(' - number of processed redirects')
     .warn('s').writeln(' - number of skipped articles')
     .warn('e').writeln(' - number of articles with no text (empty)')
-    .fail('to').writeln(' - approximate number of articles that couldn\'t be converted fast enough (timed out)')
+    .fail('to').writeln(' - number of articles that couldn\'t be converted fast enough (timed out)')
     .fail('f').writeln(' - number of articles that couldn\'t be converted (failed)'))
 
 from math import log as math_log
@@ -990,6 +2704,23 @@ def main():
     opt_parser = make_opt_parser()
     options, args = opt_parser.parse_args()
 
+    resume = None
+    if options.resume:
+        session_dir = os.path.abspath(options.resume)
+        resume = read_checkpoint(session_dir)
+        if not resume:
+            sys.stderr.write('No checkpoint found in %s, '
+                             'can\'t resume\n' % session_dir)
+            raise SystemExit(1)
+        with open(os.path.join(session_dir, SESSION_FILE)) as f:
+            session = json.load(f)
+        #input files and other paths may be relative
+        os.chdir(session['cwd'])
+        options, args = opt_parser.parse_args([arg.encode('utf8')
+                                               for arg in session['args']])
+        resume_start = options.start
+        options.start = resume['position']
+
     if not args:
         opt_parser.print_help()
         raise SystemExit(1)
@@ -1006,6 +2737,10 @@ def main():
         sys.stderr.write('No input files specified\n')
         raise SystemExit(1)
 
+    if options.format_version not in (1, 2):
+        sys.stderr.write('Unknown format version %d\n' % options.format_version)
+        raise SystemExit(1)
+
     if '-' in input_files and len(input_files) != 1:
         sys.stderr.write('stdin is specified as input file, but other files '
                          'are specified too (%s), can\'t proceed\n' % input_files)
@@ -1016,16 +2751,37 @@ def main():
             sys.stderr.write('No such file: %s\n' % input_file)
             raise SystemExit(1)
 
-    session_dir = os.path.join(options.work_dir,
-                               'aardc-'+('%.2f' % time.time()).replace('.','-'))
+    work_dirs = options.work_dir.split(',')
+    if resume:
+        display.write('Resuming session ').bold(session_dir).writeln()
+        session_name = os.path.basename(session_dir)
+    else:
+        session_name = 'aardc-'+('%.2f' % time.time()).replace('.','-')
+        session_dir = os.path.join(work_dirs[0], session_name)
 
-    if os.path.exists(session_dir):
-        sys.stderr.write('Session directory %s already'
-                         ' exists, can\'t proceed\n' % session_dir)
-        raise SystemExit(1)
+        if os.path.exists(session_dir):
+            sys.stderr.write('Session directory %s already'
+                             ' exists, can\'t proceed\n' % session_dir)
+            raise SystemExit(1)
+        else:
+            os.mkdir(session_dir)
+            display.write('Session dir ').bold(session_dir).writeln()
+        with open(os.path.join(session_dir, SESSION_FILE), 'w') as f:
+            json.dump(dict(cwd=os.getcwd(), args=sys.argv[1:]), f)
+
+    #temporary files in other work dirs are kept in
+    #directories named same as session dir
+    store_dirs = [session_dir] + [os.path.join(work_dir, session_name)
+                                  for work_dir in work_dirs[1:]]
+    if options.hot_work_dir:
+        hot_dir = os.path.join(options.hot_work_dir, session_name)
+        extra_dirs = store_dirs[1:] + [hot_dir]
     else:
-        os.mkdir(session_dir)
-        display.write('Session dir ').bold(session_dir).writeln()
+        hot_dir = None
+        extra_dirs = store_dirs[1:]
+    for extra_dir in extra_dirs:
+        if not os.path.exists(extra_dir):
+            os.mkdir(extra_dir)
 
 
     try:
@@ -1061,14 +2817,26 @@ def main():
     multiprocessing_logger.setLevel(logging.WARNING)
     multiprocessing_logger.handlers = root_logger.handlers
 
+    if options.format_version == 2:
+        block_size = parse_size(options.block_size)
+        log.info('Format version 2, article block size %d bytes, '
+                 'block compression: %s', block_size, options.compression)
+        #articles are compressed in blocks when volumes are written
+        set_compression_policy('none')
+    else:
+        block_size = 0
+        set_compression_policy(options.compression)
+        log.info('Compression: %s', options.compression)
+
     max_volume_size = max_file_size(options)
     log.info('Maximum file size is %d bytes', max_volume_size)
     if max_volume_size > MAX_FAT32_FILE_SIZE:
-        global INDEX1_ITEM_FORMAT
+        global INDEX1_ITEM_FORMAT, INDEX1_BLOCK_ITEM_FORMAT
         INDEX1_ITEM_FORMAT = '>LQ'
+        INDEX1_BLOCK_ITEM_FORMAT = '>LQL'
         log.info('Maximum file size is too big 32-bit offsets, '
                  'setting index item format to %s',
-                 INDEX1_ITEM_FORMAT)
+                 INDEX1_BLOCK_ITEM_FORMAT if block_size else INDEX1_ITEM_FORMAT)
 
     if input_type=='wiki':
         if not options.wiki_lang:
@@ -1102,13 +2870,29 @@ def main():
 
 
     compiler = Compiler(output_file_name, max_volume_size,
-                        session_dir, metadata)
+                        session_dir, metadata,
+                        sort_memory=parse_size(options.sort_memory),
+                        sort_processes=options.sort_processes,
+                        compress_threads=options.compress_threads,
+                        checkpoint_interval=options.checkpoint_interval,
+                        resume=resume,
+                        dedup=not options.no_dedup,
+                        block_size=block_size,
+                        block_compression=options.compression,
+                        prefetch_size=parse_size(options.prefetch_size),
+                        volume_processes=options.volume_processes,
+                        work_dirs=store_dirs,
+                        hot_dir=hot_dir,
+                        presorted=options.presorted)
 
 
     t0 = time.time()
     display.write('Converting ').bold(', '.join(input_files)).writeln()
 
-    if hasattr(converter, 'total'):
+    if resume:
+        log.info('Resuming from article %d in %s', options.start,
+                 input_files[compiler.input_index])
+    elif hasattr(converter, 'total'):
         display.write('Calculating total number of articles...').cr().flush()
         if options.article_count>0:
             compiler.stats.total = options.article_count
@@ -1126,16 +2910,26 @@ def main():
     if options.show_legend:
         print_legend()
 
-    for input_file in input_files:
+    for i, input_file in enumerate(input_files):
+        #input files before the one checkpoint was saved in
+        #have been collected completely
+        if i < compiler.input_index:
+            log.info('Skipping %s, already collected', input_file)
+            continue
+        if resume and i > compiler.input_index:
+            options.start = resume_start
+        compiler.input_index = i
         log.info('Collecting articles in %s', input_file)
         converter.collect_articles(converter.make_input(input_file), options, compiler)
     compiler.compile()
     if options.remove_session_dir:
         writeln('Removing session dir')
         shutil.rmtree(session_dir)
+        for extra_dir in extra_dirs:
+            shutil.rmtree(extra_dir)
     log.info(compiler.stats)
     log.info('Compression: %s',
-             ', '.join('%s - %d' % item
+             ', '.join('%s - %s' % item
                       for item in compress_counts.iteritems()))
     log.info('Compilation took %s', timedelta(seconds=time.time() - t0))
     writeln('Compilation took %s' % timedelta(seconds=int(time.time() - t0)))
@@ -0,0 +1,74 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+Compare article compression policies on articles of existing aard
+files: compressed size, compression and decompression time::
+
+  python -m aardtools.compressbench FILE [FILE...]
+
+"""
+
+import sys
+import time
+
+from aardtools import zdict
+from aardtools.compiler import (compression_policies, sizeof_fmt,
+                                DICTIONARY_SAMPLE_SIZE)
+from aardtools.reader import Volume, make_decompress
+
+POLICIES = ('best', 'zlib', 'bz2', 'zdict')
+
+def bench(name, texts, sample_size=DICTIONARY_SAMPLE_SIZE):
+    """ Compress and decompress texts with named compression policy,
+    return compressed size, compression and decompression time.
+    """
+    policy = compression_policies[name]()
+    if name == 'zdict':
+        t0 = time.time()
+        policy.compressor = zdict.Compressor(zdict.train(texts[:sample_size]))
+        print '  zdict dictionary %s trained in %.2fs' % (
+            sizeof_fmt(len(policy.compressor.dictionary)), time.time() - t0)
+    t0 = time.time()
+    compressed = [policy.compress(text)[0] for text in texts]
+    compress_time = time.time() - t0
+    decompress = make_decompress(policy.metadata())
+    t0 = time.time()
+    for c in compressed:
+        decompress(c)
+    decompress_time = time.time() - t0
+    return sum(len(c) for c in compressed), compress_time, decompress_time
+
+def main():
+    file_names = sys.argv[1:]
+    if not file_names:
+        sys.stderr.write('Usage: python -m aardtools.compressbench FILE [FILE...]\n')
+        raise SystemExit(1)
+    texts = []
+    for file_name in file_names:
+        volume = Volume(file_name)
+        texts.extend(volume.article(i) for i in xrange(len(volume)))
+        volume.close()
+    total = sum(len(text) for text in texts)
+    print '%d articles, %s' % (len(texts), sizeof_fmt(total))
+    for name in POLICIES:
+        size, compress_time, decompress_time = bench(name, texts)
+        print ('  %-6s %10s (%5.1f%%)  compress %6.2fs (%5.1fus/article)  '
+               'decompress %6.2fs (%5.1fus/article)' %
+               (name, sizeof_fmt(size), 100.0*size/total,
+                compress_time, 1e6*compress_time/len(texts),
+                decompress_time, 1e6*decompress_time/len(texts)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+Compare writing index 1 of a volume item by item with writing it in
+blocks of items packed at once, on generated articles::
+
+  python -m aardtools.indexbench [ARTICLE_COUNT]
+
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from aardtools.compiler import (Compiler, VolumeFile, KEY_LENGTH_FORMAT,
+                                INDEX1_ITEM_FORMAT)
+
+def write_index1_items(compiler, output_file, volume):
+    """ Write index 1 packing and writing one item at a time. """
+    key_length_len = struct.calcsize(KEY_LENGTH_FORMAT)
+    index2ptr = 0
+    for record, offset, new in compiler.article_store.volume_articles(volume.first,
+                                                                      volume.end):
+        output_file.write(struct.pack(INDEX1_ITEM_FORMAT, index2ptr, offset))
+        index2ptr += key_length_len + record[1]
+
+def best_time(write, file_name, repeat=3):
+    """ Return shortest time it took to write file and file content. """
+    times = []
+    for i in range(repeat):
+        output_file = VolumeFile(file_name)
+        t0 = time.time()
+        write(output_file)
+        times.append(time.time() - t0)
+        output_file.close()
+    with open(file_name, 'rb') as f:
+        return min(times), f.read()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    work_dir = tempfile.mkdtemp()
+    c = Compiler(os.path.join(work_dir, 'bench.aar'), 2**31-1, work_dir, {})
+    try:
+        for i in xrange(count):
+            c.article_store.append('title%09d' % i, 'x'*(i % 50))
+        c.store_writer.close()
+        c.article_store.sort()
+        volume = c.plan_volumes(0)[0]
+        file_name = os.path.join(work_dir, 'index1')
+        items_time, items_data = best_time(
+            lambda f: write_index1_items(c, f, volume), file_name)
+        blocks_time, blocks_data = best_time(
+            lambda f: c.write_index1(f, volume), file_name)
+        c.article_store.close()
+        print '%d items' % count
+        print '  item by item: %.3fs' % items_time
+        print '  in blocks:    %.3fs (%.1fx)' % (blocks_time,
+                                                  items_time/blocks_time)
+        if items_data != blocks_data:
+            print '  output differs!'
+            raise SystemExit(1)
+    finally:
+        c.close_lists()
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
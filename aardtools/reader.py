@@ -0,0 +1,203 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+Minimal reader for aard files of format version 1, 2 and 3 (same as
+version 1, articles may need preset dictionary from metadata), used to
+verify compiled files and to compare article lookup latency::
+
+  python -m aardtools.reader FILE [FILE...]
+
+"""
+
+from __future__ import with_statement
+import functools
+import mmap
+import random
+import struct
+import sys
+import time
+import zlib
+import bz2
+import base64
+from hashlib import sha1
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from aarddict.dictionary import HEADER_SPEC, spec_len
+
+from aardtools import zdict
+
+#Number of uncompressed blocks kept in memory
+BLOCK_CACHE_SIZE = 8
+
+def make_decompress(metadata):
+    """ Return function that decompresses article with any of the codecs
+    used by compiler, including preset dictionary found in
+    `metadata`, or returns it as is if it's not compressed.
+    """
+    codecs = [zlib.decompress, bz2.decompress]
+    if 'compression_dictionary' in metadata:
+        prefix = base64.b64decode(metadata['compression_dictionary'])
+        codecs.append(zdict.Decompressor(prefix).decompress)
+    def decompress(s):
+        for codec in codecs:
+            try:
+                return codec(s)
+            except Exception:
+                pass
+        return s
+    return decompress
+
+def read_header(f):
+    header = {}
+    for name, fmt in HEADER_SPEC:
+        header[name] = struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+    return header
+
+
+class Volume(object):
+
+    def __init__(self, file_name, block_cache_size=BLOCK_CACHE_SIZE):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            header = self.header = read_header(f)
+            if header['signature'] != 'aard':
+                raise ValueError('%s is not an aard file' % file_name)
+            if header['version'] not in (1, 2, 3):
+                raise ValueError('%s: unsupported format version %d' %
+                                 (file_name, header['version']))
+            self.metadata = json.loads(make_decompress({})(f.read(header['meta_length'])))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = header['version']
+        self.index_count = header['index_count']
+        index1_item_format = header['index1_item_format'].rstrip('\0')
+        self.index1_item_len = struct.calcsize(index1_item_format)
+        self.unpack_index1 = functools.partial(struct.unpack, index1_item_format)
+        self.key_length_format = header['key_length_format'].rstrip('\0')
+        self.article_length_format = header['article_length_format'].rstrip('\0')
+        self.index1_offset = spec_len(HEADER_SPEC) + header['meta_length']
+        self.index2_offset = (self.index1_offset +
+                              self.index_count*self.index1_item_len)
+        self.article_offset = header['article_offset']
+        self.decompress = make_decompress(self.metadata)
+        self.block_cache_size = block_cache_size
+        self.blocks = {}
+        self.block_order = []
+        #number of blocks read and decompressed
+        self.block_reads = 0
+
+    def __len__(self):
+        return self.index_count
+
+    def index1(self, i):
+        start = self.index1_offset + i*self.index1_item_len
+        return self.unpack_index1(self.map[start:start+self.index1_item_len])
+
+    def unit(self, data, offset, length_format):
+        """ Return length prefixed string at `offset`. """
+        prefix_len = struct.calcsize(length_format)
+        length, = struct.unpack(length_format,
+                                data[offset:offset+prefix_len])
+        start = offset + prefix_len
+        return data[start:start+length]
+
+    def title(self, i):
+        return self.unit(self.map, self.index2_offset + self.index1(i)[0],
+                         self.key_length_format).decode('utf8')
+
+    def article(self, i):
+        item = self.index1(i)
+        if self.version != 2:
+            return self.decompress(self.unit(self.map,
+                                             self.article_offset + item[1],
+                                             self.article_length_format))
+        return self.unit(self.block(item[1]), item[2],
+                         self.article_length_format)
+
+    def block(self, ptr):
+        """ Return uncompressed block, recently used blocks are
+        cached.
+        """
+        if ptr in self.blocks:
+            self.block_order.remove(ptr)
+            self.block_order.append(ptr)
+            return self.blocks[ptr]
+        data = self.decompress(self.unit(self.map, self.article_offset + ptr,
+                                         self.article_length_format))
+        self.block_reads += 1
+        self.blocks[ptr] = data
+        self.block_order.append(ptr)
+        if len(self.block_order) > self.block_cache_size:
+            del self.blocks[self.block_order.pop(0)]
+        return data
+
+    def verify(self):
+        """ Return True if sha1 sum in header matches file content. """
+        return (sha1(self.map[spec_len(HEADER_SPEC[:2]):]).hexdigest() ==
+                self.header['sha1sum'])
+
+    def items(self):
+        for i in xrange(self.index_count):
+            yield self.title(i), self.article(i)
+
+    def close(self):
+        self.map.close()
+
+
+def lookup_times(volume, indices):
+    """ Return list of seconds it took to read each article. """
+    times = []
+    for i in indices:
+        t0 = time.time()
+        volume.article(i)
+        times.append(time.time() - t0)
+    return times
+
+def percentile(values, p):
+    return sorted(values)[min(len(values) - 1, int(len(values)*p))]
+
+def main():
+    file_names = sys.argv[1:]
+    if not file_names:
+        sys.stderr.write('Usage: python -m aardtools.reader FILE [FILE...]\n')
+        raise SystemExit(1)
+    for file_name in file_names:
+        volume = Volume(file_name)
+        count = len(volume)
+        print ('%s: format version %d, %d articles, sha1 %s' %
+               (file_name, volume.version, count,
+                'ok' if volume.verify() else 'mismatch'))
+        sample = min(count, 1000)
+        for order, indices in (('random', random.sample(xrange(count), sample)),
+                               ('sequential', xrange(sample))):
+            volume.blocks.clear()
+            del volume.block_order[:]
+            volume.block_reads = 0
+            times = lookup_times(volume, indices)
+            if not times:
+                continue
+            print ('  %s: mean %.1fus, median %.1fus, 99%% %.1fus, '
+                   '%d blocks read' % (order,
+                                       1e6*sum(times)/len(times),
+                                       1e6*percentile(times, 0.5),
+                                       1e6*percentile(times, 0.99),
+                                       volume.block_reads))
+        volume.close()
+
+if __name__ == '__main__':
+    main()
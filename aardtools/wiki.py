@@ -17,6 +17,7 @@ from __future__ import with_statement
 import functools
 import logging
 import os
+import time
 from itertools import islice
 
 try:
@@ -39,14 +40,18 @@ Expander.parsedTemplateCache = lrucache.lrucache(100)
 tojson = functools.partial(json.dumps, ensure_ascii=False)
 
 import multiprocessing
-from multiprocessing import Pool, TimeoutError
 from mwlib.cdb.cdbwiki import WikiDB
 from mwlib._version import version as mwlib_version
 import mwlib.siteinfo
 
 import mwaardhtmlwriter as writer
+from aardtools.compiler import sortkey, compress_with_codec
+from aardtools.articlecache import ArticleCache, CacheWriter, digest
+from aardtools.workers import WorkerPool, TaskTimeout
+import aardtools
 
 import re
+from hashlib import sha1
 
 lic_dir = os.path.join(os.path.dirname(__file__), 'licenses')
 
@@ -56,16 +61,27 @@ known_licenses = {"Creative Commons Attribution-Share Alike 3.0 Unported":
                   os.path.join(lic_dir, "gfdl-1.2.txt")}
 
 wikidb = None
+article_cache = None
 log = logging.getLogger('wiki')
 
 def _create_wikidb(cdbdir, lang, rtl, filters):
     global wikidb
     wikidb = Wiki(cdbdir, lang, rtl, filters)
 
-def _init_process(cdbdir, lang, rtl, filters):
-    global log
+def _init_process(cdbdir, lang, rtl, filters, cache_args=None):
+    global log, article_cache
     log = multiprocessing.get_logger()
     _create_wikidb(cdbdir, lang, rtl, filters)
+    if cache_args:
+        article_cache = ArticleCache(*cache_args)
+
+#Arguments for _init_process in worker processes, set before worker
+#pool is created and inherited by workers when they are forked
+#instead of being pickled for each of them
+worker_args = None
+
+def _init_worker():
+    _init_process(*worker_args)
 
 class ConvertError(Exception):
 
@@ -94,11 +110,19 @@ class ConvertError(Exception):
 
 class EmptyArticleError(ConvertError): pass
 
-def mkredirect(title, redirect_target):
-    meta = {u'r': redirect_target}
-    return title, tojson(('', [], meta)), True, None
-
 def convert(title):
+    """ Convert article, return tuple of title, compressed article 
+    (redirect target for redirects), redirect flag, language links, 
+    article size, title sort key, compression report and article
+    cache entry.
+
+    Cache entry is None if article cache is not used, otherwise it's
+    a tuple of cache key, dependencies (None if article was found in
+    cache), time it took to convert article (time saved for
+    cached articles) and serialized article to cache (None if article
+    was found in cache). Cache keeps articles uncompressed, cached
+    articles are compressed with current compression policy.
+    """
     try:
         text = wikidb.reader[title]
         size = wikidb.reader.getitem_size(title)
@@ -108,7 +132,19 @@ def convert(title):
 
         redirect = wikidb.get_redirect(text)
         if redirect:
-            return mkredirect(title, redirect) + ( size, )
+            return title, redirect, True, None, size, sortkey(title), None, None
+
+        t0 = time.time()
+        if article_cache:
+            key = article_cache.key(title, text)
+            cached = article_cache.get(key, wikidb.page_digest)
+            if cached:
+                serialized, languagelinks, seconds = cached
+                compressed, report = compress_with_codec(serialized)
+                return (title, compressed, False, languagelinks, size,
+                        sortkey(title), report,
+                        (key, None, seconds - (time.time() - t0), None))
+            wikidb.dependencies = {}
 
         mwobject = uparser.parseString(title=title,
                                        raw=text,
@@ -122,13 +158,27 @@ def convert(title):
           for item in wikidb.filters['REGEX']:
             text = item['re'].sub( item['sub'], text )
 
+        serialized = tojson((text.rstrip(), tags))
+
     except EmptyArticleError:
         raise
     except Exception:
         log.exception('Failed to process article %s', title.encode('utf8'))
         raise ConvertError(title)
     else:
-        return title, tojson((text.rstrip(), tags)), False, languagelinks, size
+        if isinstance(serialized, unicode):
+            serialized = serialized.encode('utf8')
+        compressed, report = compress_with_codec(serialized)
+        if article_cache:
+            cache_entry = (key, wikidb.dependencies.items(), time.time() - t0,
+                           serialized)
+        else:
+            cache_entry = None
+        return (title, compressed, False, languagelinks,
+                size, sortkey(title), report, cache_entry)
+    finally:
+        if wikidb:
+            wikidb.dependencies = None
 
 
 class BadRedirect(ConvertError): pass
@@ -202,6 +252,19 @@ class Wiki(WikiDB):
             self.redirect_aliases.add(alias.upper())
 
         self.filters = filters
+        #names and digests of pages fetched while converting article,
+        #recorded when article cache is used
+        self.dependencies = None
+        self.page_digests = {}
+
+    def page_digest(self, name):
+        """ Return :func:`aardtools.articlecache.digest` of page's
+        current text.
+        """
+        if name not in self.page_digests:
+            page = self.get_page(name)
+            self.page_digests[name] = digest(page.rawtext if page else None)
+        return self.page_digests[name]
 
     def get_redirect(self, text):
         redirect = parse_redirect(text, self.redirect_aliases)
@@ -226,9 +289,12 @@ class Wiki(WikiDB):
 
     def get_page(self,  name,  revision=None):
         if (name in self.filters['EXCLUDE_PAGES']):
-          return
+          page = None
         else:
-          return WikiDB.get_page(self, name, revision)
+          page = WikiDB.get_page(self, name, revision)
+        if self.dependencies is not None:
+            self.dependencies[name] = digest(page.rawtext if page else None)
+        return page
 
     def normalize_and_get_page(self, name, defaultns):
         fqname = self.nshandler.get_fqname(name, defaultns=defaultns)
@@ -308,7 +374,8 @@ def load_filters(filename):
         raise Exception('File %s not found' % filename)
 
     with open(filename) as f:
-        filters = yaml.load(f)
+        text = f.read()
+    filters = yaml.load(text)
 
     for filter_section in ['EXCLUDE_PAGES', 'EXCLUDE_CLASSES', 'EXCLUDE_IDS', 'TEXT_REPLACE']:
       if (filter_section not in filters or filters[filter_section] is None):
@@ -322,6 +389,9 @@ def load_filters(filename):
            sub = item['sub']
          filters['REGEX'].append( { "re": re.compile(item['re']), "sub": sub } )
 
+    #identifies filters in article cache salt
+    filters['DIGEST'] = sha1(text).hexdigest()
+
     return filters
 
 default_description = """ %(title)s for Aard Dictionary is a collection of text documents from %(server)s (articles only). Some documents or portions of documents may have been omited or could not be converted to Aard Dictionary format. All documents can be found online at %(server)s under the same title as displayed in Aard Dictionary.
@@ -408,15 +478,33 @@ class WikiParser():
         self.processes = options.processes if options.processes else None
         self.pool = None
         self.timeout = options.timeout
-        self.timedout_count = 0
+        self.timeout_per_kb = options.timeout_per_kb
+        self.retry_processes = options.retry_processes
+        self.retry_timeout_factor = options.retry_timeout_factor
+        self.retry_pool = None
+        #sizes of articles in current chunk
+        self.sizes = {}
+        self.largest_first = options.largest_first
+        #seconds workers spent converting articles and seconds they
+        #were available for it
+        self.busy_time = 0.0
+        self.available_time = 0.0
+        self.real_article_count = 0
         self.start = options.start
         self.end = options.end
+        #number of input articles handed out for processing,
+        #including skipped ones
+        self.position = self.start
         if options.nomp:
             log.info('Disabling multiprocessing')
-            self.parse = self.parse_simple
+            self.parse_articles = self.parse_simple
         else:
-            self.parse = self.parse_mp
+            self.parse_articles = self.parse_mp
         self.mp_chunk_size = options.mp_chunk_size
+        self.worker_tasks = options.worker_tasks or None
+        self.max_batch_size = options.max_batch_size
+        self.worker_max_age = options.worker_max_age
+        self.pool_started = None
 
         if options.lang_links:
             self.lang_links_langs = frozenset(l.strip().lower()
@@ -428,6 +516,21 @@ class WikiParser():
 
         self.requested_article_count = options.article_count
 
+        if options.article_cache:
+            filters_digest = self.filters['DIGEST']
+            salt = sha1(tojson((aardtools.__version__, mwlib_version,
+                                wiki_lang, self.rtl, siteinfo,
+                                filters_digest)).encode('utf8')).hexdigest()
+            self.cache_args = (options.article_cache, salt)
+            #parent writes cache in a separate process, connection
+            #must not be inherited by workers it forks
+            self.article_cache = CacheWriter(*self.cache_args)
+            log.info('Using article cache %s', options.article_cache)
+        else:
+            self.cache_args = None
+            self.article_cache = None
+        self.prune_article_cache = options.prune_article_cache
+
 
     def articles(self, f):
         if self.start > 0:
@@ -435,6 +538,7 @@ class WikiParser():
         _create_wikidb(f, self.lang, self.rtl, self.filters)
         for title in islice(wikidb.articles(), self.start, self.end):
             log.debug('Yielding "%s" for processing', title.encode('utf8'))
+            self.position += 1
             yield title
 
     def articles_sizes(self, f):
@@ -443,93 +547,194 @@ class WikiParser():
         _create_wikidb(f, self.lang, self.rtl, self.filters)
         for (title, size) in islice(wikidb.articles_sizes(), self.start, self.end):
             log.debug('Yielding "%s" for processing', title.encode('utf8'))
+            self.position += 1
             yield (title,size)
 
+    def article_timeout(self, title):
+        """ Return number of seconds article may take to convert,
+        growing with article's size.
+        """
+        return self.timeout + self.timeout_per_kb*self.sizes.get(title, 0)/1024.0
+
+    def retry_timeout(self, title):
+        return self.retry_timeout_factor*self.article_timeout(title)
+
     def reset_pool(self, cdbdir, terminate=True):
+        global worker_args
         if self.pool and terminate:
             log.info('Terminating current worker pool')
             self.pool.terminate()
         log.info('Creating new worker pool with wiki cdb at %s', cdbdir)
+        worker_args = (cdbdir, self.lang, self.rtl, self.filters,
+                       self.cache_args)
+        #pool replaces each worker after it completes worker_tasks
+        #articles, workers keep their wiki db and caches until then;
+        #worker stuck on an article past timeout is killed and replaced
+        self.pool = WorkerPool(processes=self.processes,
+                               initializer=_init_worker,
+                               maxtasks=self.worker_tasks,
+                               timeout=self.article_timeout,
+                               max_batch_size=self.max_batch_size)
+        self.pool_started = time.time()
+
+    def pool_expired(self):
+        return (self.worker_max_age and
+                time.time() - self.pool_started > self.worker_max_age)
+
+    def parse(self, f):
+        if self.article_cache:
+            try:
+                self.parse_articles(f)
+            finally:
+                self.close_article_cache()
+        else:
+            self.parse_articles(f)
 
-        self.pool = Pool(processes=self.processes,
-                         initializer=_init_process,
-                         initargs=[cdbdir, self.lang, self.rtl, self.filters])
+    def close_article_cache(self):
+        cache = self.article_cache
+        log.info('Article cache: %s', cache.stats)
+        if self.prune_article_cache:
+            log.info('Removed %d unused articles from article cache',
+                     cache.prune())
+        cache.close()
 
     def parse_simple(self, f):
-        _init_process(f, self.lang, self.rtl, self.filters)
+        _init_process(f, self.lang, self.rtl, self.filters, self.cache_args)
         self.consumer.add_metadata('article_format', 'html')
         articles = self.articles(f)
         for a in articles:
             try:
-                result = convert(a)
-                title, serialized, redirect, langugagelinks, size = result
-                self.consumer.add_article(title, serialized, redirect, True, size)
-                self.process_languagelinks(title, langugagelinks)
+                self.add_result(convert(a))
             except EmptyArticleError, e:
                 self.consumer.empty_article(e.title)
             except ConvertError, e:
                 self.consumer.fail_article(e.title)
+            self.consumer.checkpoint(self.position)
 
     def parse_mp(self, f):
+        self.consumer.add_metadata('article_format', 'html')
+        articles = self.articles_sizes(f)
+        self.reset_pool(f)
         try:
-            self.consumer.add_metadata('article_format', 'html')
-            articles = self.articles(f)
-            self.reset_pool(f)
-            iter_count = 1
-            real_article_count = 0
             while True:
-                if iter_count:
-                    chunk = islice(articles, self.mp_chunk_size)
-                    iter_count = 0
-                else:
+                chunk = list(islice(articles, self.mp_chunk_size))
+                if not chunk:
                     break
-
-                resulti = self.pool.imap_unordered(convert, chunk)
-                while True:
-                    try:
-                        result = resulti.next(self.timeout)
-                        iter_count += 1
-                        title, serialized, redirect, langugagelinks, size  = result
-
-                        if self.requested_article_count:
-                            if  not redirect:
-                                real_article_count += 1
-                                self.consumer.add_article(title, serialized, redirect, True, size)
-                                self.process_languagelinks(title, langugagelinks)
-                                if real_article_count >= self.requested_article_count:
-                                    try:
-                                        self.pool.terminate()
-                                    except:
-                                        log.exception()
-                                    finally:
-                                        return
-                        else:
-                            self.consumer.add_article(title, serialized, redirect, True, size)
-                            self.process_languagelinks(title, langugagelinks)
-                    except StopIteration:
-                        break
-                    except TimeoutError:
-                        log.warn('Worker pool timed out')
-                        self.consumer.timedout(count=len(multiprocessing.active_children()))
-                        self.reset_pool(f)
-                        resulti = self.pool.imap_unordered(convert, chunk)
-                    except AssertionError:
-                        log.exception()
-                    except EmptyArticleError, e:
-                        self.consumer.empty_article(e.title)
-                    except ConvertError, e:
-                        self.consumer.fail_article(e.title)
-                    except KeyboardInterrupt:
-                        log.error('Keyboard interrupt: '
-                                  'terminating worker pool')
-                        self.pool.terminate()
-                        raise
-
-                self.pool.close()
-                self.reset_pool(f, terminate=False)
+                self.sizes = dict(chunk)
+                if self.largest_first:
+                    #longest processing time first, so that workers
+                    #don't wait for the few largest articles at the end
+                    chunk.sort(key=lambda item: item[1], reverse=True)
+                    #chunk starts with it's largest articles right
+                    #after previous one ended with the smallest, batch
+                    #size learned on those would be too large
+                    self.pool.reset_batch_size()
+                if self.convert_chunk(f, [title for title, size in chunk]):
+                    return
+                self.update_utilisation()
+                #all articles handed out so far are done
+                self.consumer.checkpoint(self.position)
+                if self.pool_expired():
+                    log.info('Worker pool is older than %ds, replacing it',
+                             self.worker_max_age)
+                    self.pool.close()
+                    self.reset_pool(f, terminate=False)
+        except KeyboardInterrupt:
+            log.error('Keyboard interrupt: '
+                      'terminating worker pool')
+            raise
         finally:
-            self.pool.close()
-            self.pool.join()
+            self.pool.terminate()
+            if self.retry_pool:
+                self.retry_pool.terminate()
+            if self.available_time:
+                log.info('Worker utilisation: %.1f%% (%.1fs converting of '
+                         '%.1fs available)',
+                         100*self.busy_time/self.available_time,
+                         self.busy_time, self.available_time)
+
+    def convert_chunk(self, f, titles):
+        """ Convert articles with worker pool, then retry ones that
+        timed out, return True if requested number of articles is
+        reached.
+        """
+        retries = []
+        for title, result, error in self.pool.imap_unordered(convert, titles):
+            if isinstance(error, TaskTimeout) and self.retry_processes:
+                retries.append(title)
+            elif self.handle_result(title, result, error):
+                return True
+        if retries:
+            log.info('Retrying %d timed out articles', len(retries))
+            for title, result, error in self.retry(f, retries):
+                if error is None:
+                    self.consumer.recovered(title)
+                if self.handle_result(title, result, error):
+                    return True
+        return False
+
+    def update_utilisation(self):
+        busy_time, available_time = self.pool.take_stats()
+        if available_time:
+            log.debug('Worker utilisation in last chunk: %.1f%%',
+                      100*busy_time/available_time)
+        self.busy_time += busy_time
+        self.available_time += available_time
+
+    def retry(self, f, titles):
+        """ Convert articles that timed out again with a pool of
+        `retry_processes` workers and much longer timeouts.
+        """
+        if not self.retry_pool:
+            self.retry_pool = WorkerPool(processes=self.retry_processes,
+                                         initializer=_init_worker,
+                                         maxtasks=self.worker_tasks,
+                                         timeout=self.retry_timeout,
+                                         max_batch_size=1)
+        return self.retry_pool.imap_unordered(convert, titles)
+
+    def handle_result(self, title, result, error):
+        """ Add converted article or record why it wasn't converted,
+        return True if requested number of articles is reached.
+        """
+        if error is None:
+            redirect = result[2]
+            if self.requested_article_count:
+                if not redirect:
+                    self.real_article_count += 1
+                    self.add_result(result)
+                    if self.real_article_count >= self.requested_article_count:
+                        return True
+            else:
+                self.add_result(result)
+        elif isinstance(error, TaskTimeout):
+            self.consumer.timedout(title)
+        elif isinstance(error, EmptyArticleError):
+            self.consumer.empty_article(error.title)
+        elif isinstance(error, ConvertError):
+            self.consumer.fail_article(error.title)
+        else:
+            log.error('Failed to convert "%s": %r',
+                      title.encode('utf8'), error)
+            self.consumer.fail_article(title)
+        return False
+
+    def add_result(self, result):
+        (title, payload, redirect,
+         languagelinks, size, sort_key, report, cache_entry) = result
+        if redirect:
+            self.consumer.add_redirect(title, payload, True, size, sort_key)
+        else:
+            self.consumer.add_compressed_article(title, payload, False,
+                                                 True, size, sort_key, report)
+            self.process_languagelinks(title, languagelinks)
+            if cache_entry:
+                key, dependencies, seconds, serialized = cache_entry
+                if dependencies is None:
+                    self.article_cache.touch(key, seconds)
+                else:
+                    self.article_cache.put(key, dependencies, serialized,
+                                           languagelinks, seconds)
 
     def process_languagelinks(self, title, languagelinks):
         if not languagelinks:
@@ -550,8 +755,6 @@ class WikiParser():
                 else:
                     log.warn('Invalid language link "%s"', target.encode('utf8'))
         for target in targets:
-            (l_title, l_serialized,
-             l_redirect, l_langugagelinks) = mkredirect(wikidb.nshandler.get_fqname(target), title)
-            self.consumer.add_article(l_title, l_serialized,
-                                      redirect=True, count=False)
+            self.consumer.add_redirect(wikidb.nshandler.get_fqname(target),
+                                       title, count=False)
 
@@ -0,0 +1,338 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+Pool of worker processes that keeps track of which item each worker is
+working on, so that a worker stuck on one item past it's deadline can
+be killed and replaced without losing work done by other workers.
+
+Items are sent to workers in batches to save inter-process round trips
+on items that take little time to process, batch size adapts to
+observed processing time. Workers send back result of each item as
+soon as it is done, so every item gets it's own deadline no matter
+how large the batch is.
+"""
+
+import cPickle
+import logging
+import os
+import select
+import signal
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Process, Pipe, cpu_count
+
+log = logging.getLogger('workers')
+
+class TaskTimeout(Exception):
+    """ Item was not processed in time, worker processing it was
+    killed.
+    """
+
+class WorkerExited(Exception):
+    """ Worker process exited while processing item. """
+
+#Batches are sized to take about this many seconds to process
+BATCH_TIME = 0.02
+#Maximum number of items sent to worker at once
+MAX_BATCH_SIZE = 64
+#Weight of last batch in moving average of item processing time
+LATENCY_WEIGHT = 0.1
+
+def _picklable(result):
+    try:
+        cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        return result
+    except Exception, e:
+        return None, Exception(repr(e))
+
+def _work(conn, initializer, maxtasks):
+    if initializer:
+        initializer()
+    completed = 0
+    while maxtasks is None or completed < maxtasks:
+        try:
+            task = conn.recv()
+        except (EOFError, IOError):
+            break
+        if task is None:
+            break
+        func, items = task
+        for item in items:
+            try:
+                result = func(item), None
+            except Exception, e:
+                result = None, e
+            try:
+                conn.send(result)
+            except Exception:
+                #result or exception can't be pickled
+                conn.send(_picklable(result))
+        completed += len(items)
+    conn.close()
+
+
+class Worker(object):
+
+    def __init__(self, initializer, maxtasks):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_work,
+                               args=(child_conn, initializer, maxtasks))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        #items of submitted batch not done yet, time batch was
+        #submitted and time by which current item must be done
+        self.items = None
+        self.batch_size = 0
+        self.submitted = None
+        self.deadline = None
+        self.timeout = None
+        self.completed = 0
+
+    busy = property(lambda self: self.items is not None)
+
+    item = property(lambda self: self.items[0])
+
+    def submit(self, func, items, timeout):
+        """ Send batch of items to worker. `timeout` is a function
+        returning timeout for an item.
+        """
+        self.conn.send((func, items))
+        self.items = deque(items)
+        self.batch_size = len(items)
+        self.submitted = time.time()
+        self.timeout = timeout
+        self.start(self.submitted)
+
+    def start(self, now):
+        timeout = self.timeout(self.item)
+        self.deadline = now + timeout if timeout else None
+
+    def receive(self):
+        """ Return (result, exception) tuple for current item, or None
+        if worker exited.
+        """
+        try:
+            return self.conn.recv()
+        except (EOFError, IOError):
+            return None
+
+    def done(self, now):
+        """ Move on to the next item of the batch. """
+        self.items.popleft()
+        self.completed += 1
+        if self.items:
+            self.start(now)
+        else:
+            self.items = None
+            self.deadline = None
+
+    def stop(self):
+        if self.busy:
+            #let worker finish the batch
+            for item in list(self.items):
+                if self.receive() is None:
+                    break
+            self.items = None
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(1)
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """ Pool of `processes` worker processes, each runs `initializer`
+    when started and is replaced with a new one after processing
+    `maxtasks` items. Worker that doesn't finish an item within
+    `timeout` seconds is killed and replaced. `timeout` may also be a
+    function that returns timeout for an item.
+
+    Up to `max_batch_size` items are sent to a worker at once. Worker
+    reports each item as it is done and each item is given it's own
+    timeout starting when worker is done with the previous one. Items
+    of a batch left after the item that timed out or made worker exit
+    are submitted again.
+
+    Workers are forked, so they inherit module globals set before pool
+    is created.
+    """
+
+    def __init__(self, processes=None, initializer=None, maxtasks=None,
+                 timeout=None, max_batch_size=MAX_BATCH_SIZE):
+        self.initializer = initializer
+        self.maxtasks = maxtasks
+        self.timeout = timeout
+        self.max_batch_size = max_batch_size
+        #moving average of seconds it takes to process an item
+        self.latency = None
+        self.workers = [Worker(initializer, maxtasks)
+                        for i in range(processes or cpu_count())]
+        #seconds workers spent processing items and seconds they
+        #were available to process items, see take_stats()
+        self.busy_time = 0.0
+        self.available_time = 0.0
+
+    def take_stats(self):
+        """ Return seconds workers spent processing items and seconds
+        they were available while items were processed since last
+        call.
+        """
+        stats = self.busy_time, self.available_time
+        self.busy_time = self.available_time = 0.0
+        return stats
+
+    def item_timeout(self, item):
+        if callable(self.timeout):
+            return self.timeout(item)
+        return self.timeout
+
+    def batch_size(self):
+        if not self.latency:
+            return 1
+        return max(1, min(self.max_batch_size,
+                          int(BATCH_TIME/self.latency)))
+
+    def reset_batch_size(self):
+        """ Forget observed item processing time, so that batches start
+        again from one item, for example when items that follow are
+        known to take longer.
+        """
+        self.latency = None
+
+    def observe(self, seconds, count):
+        latency = seconds/count
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT*(latency - self.latency)
+
+    def replace(self, worker, kill=False):
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+        self.workers[self.workers.index(worker)] = Worker(self.initializer,
+                                                          self.maxtasks)
+
+    def imap_unordered(self, func, iterable):
+        """ Apply `func` to each item in worker processes, generate
+        tuples of item, result and exception raised by `func` (None if
+        there was no exception) in the order items are done. Exception
+        is :class:`TaskTimeout` if item was not done in time and
+        :class:`WorkerExited` if worker died processing it.
+        """
+        t0 = time.time()
+        try:
+            for result in self._imap_unordered(func, iterable):
+                yield result
+        finally:
+            self.available_time += (time.time() - t0)*len(self.workers)
+
+    def _imap_unordered(self, func, iterable):
+        items = iter(iterable)
+        #items left over from batches of killed workers, submitted
+        #again before new items
+        requeued = deque()
+        while True:
+            for worker in self.workers:
+                if worker.busy:
+                    continue
+                size = self.batch_size()
+                if self.maxtasks:
+                    #worker exits once it's done maxtasks items
+                    size = min(size, self.maxtasks - worker.completed)
+                batch = [requeued.popleft()
+                         for i in range(min(size, len(requeued)))]
+                batch.extend(islice(items, size - len(batch)))
+                if not batch:
+                    break
+                worker.submit(func, batch, self.item_timeout)
+            busy = [worker for worker in self.workers if worker.busy]
+            if not busy:
+                return
+            deadlines = [worker.deadline for worker in busy
+                         if worker.deadline]
+            if deadlines:
+                wait = max(0, min(deadlines) - time.time())
+            else:
+                wait = None
+            ready = select.select([worker.conn for worker in busy],
+                                  [], [], wait)[0]
+            now = time.time()
+            for worker in busy:
+                if worker.conn in ready:
+                    for result in self.collect(worker, requeued, now):
+                        yield result
+                elif worker.deadline and now >= worker.deadline:
+                    item = worker.item
+                    log.warn('Worker %d timed out processing %r, killing it',
+                             worker.process.pid, item)
+                    self.discard(worker, requeued, now)
+                    yield item, None, TaskTimeout(item)
+
+    def collect(self, worker, requeued, now):
+        """ Generate results worker sent back so far. `now` is
+        replaced with the time each result is received.
+        """
+        while worker.busy and worker.conn.poll():
+            item = worker.item
+            result = worker.receive()
+            #caller may have spent a while on previous results, next
+            #item's deadline starts when this one is received
+            now = time.time()
+            if result is None:
+                log.warn('Worker %d exited while processing %r',
+                         worker.process.pid, item)
+                self.discard(worker, requeued, now)
+                yield item, None, WorkerExited(item)
+                return
+            worker.done(now)
+            if not worker.busy:
+                self.busy_time += now - worker.submitted
+                self.observe(now - worker.submitted, worker.batch_size)
+                if self.maxtasks and worker.completed >= self.maxtasks:
+                    self.replace(worker)
+            yield (item,) + tuple(result)
+
+    def discard(self, worker, requeued, now):
+        """ Kill and replace worker that failed it's current item,
+        queue rest of it's batch to be submitted again.
+        """
+        self.busy_time += now - worker.submitted
+        requeued.extend(list(worker.items)[1:])
+        self.replace(worker, kill=True)
+
+    def close(self):
+        """ Stop workers once they are done with their items. """
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def terminate(self):
+        """ Kill workers right away. """
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
@@ -0,0 +1,97 @@
+# This file is part of Aard Dictionary Tools <http://aarddict.org>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License <http://www.gnu.org/licenses/gpl-3.0.txt>
+# for more details.
+#
+# Copyright (C) 2008-2009  Igor Tkach
+
+"""
+zlib compression with preset dictionary for short articles that share
+a lot of markup.
+
+Python 2 zlib module can't set preset dictionary, so instead compressor
+is primed by compressing the dictionary and flushing, and each article
+is compressed by a copy of primed compressor. Compressed article is
+continuation of primed stream: to decompress it decompressor is primed
+with `prefix` - compressed dictionary, which is stored in dictionary
+metadata.
+
+>>> c = Compressor(train(['<b class="x">one</b>', '<b class="x">two</b>']))
+>>> c.dictionary
+'</b><b class="x">'
+>>> d = Decompressor(c.prefix)
+>>> d.decompress(c.compress('<b class="x">three</b>'))
+'<b class="x">three</b>'
+
+"""
+
+import re
+import zlib
+from collections import defaultdict
+
+#Maximum dictionary length, deflate can't refer further back than 32K
+DICTIONARY_SIZE = 16*1024
+#Dictionary is built from tags and words
+TOKEN_RE = re.compile(r'<[^<>]{1,200}>|[^<>\s]{2,50}\s?')
+
+def train(samples, size=DICTIONARY_SIZE):
+    """ Return dictionary made of tokens (tags and words) found in more
+    than one of sample texts. Tokens that are expected to save more
+    bytes are placed closer to the end of dictionary, nearer to
+    compressed text.
+    """
+    counts = defaultdict(int)
+    for text in samples:
+        for token in set(TOKEN_RE.findall(text)):
+            counts[token] += 1
+    tokens = sorted((token for token, count in counts.iteritems()
+                     if count > 1),
+                    key=lambda token: (counts[token]*len(token), token),
+                    reverse=True)
+    chosen = []
+    length = 0
+    for token in tokens:
+        if length + len(token) <= size:
+            chosen.append(token)
+            length += len(token)
+    chosen.reverse()
+    return ''.join(chosen)
+
+
+class Compressor(object):
+
+    def __init__(self, dictionary, level=9):
+        self.dictionary = dictionary
+        self.primed = zlib.compressobj(level)
+        self.prefix = (self.primed.compress(dictionary) +
+                       self.primed.flush(zlib.Z_SYNC_FLUSH))
+
+    def compress(self, text):
+        c = self.primed.copy()
+        return c.compress(text) + c.flush()
+
+
+class Decompressor(object):
+
+    def __init__(self, prefix):
+        self.primed = zlib.decompressobj()
+        self.primed.decompress(prefix)
+
+    def decompress(self, compressed):
+        """ Decompress text compressed by :class:`Compressor`, raise
+        zlib.error if it's not a complete compressed stream.
+        """
+        d = self.primed.copy()
+        #marker ends up in unused data only if stream is complete
+        #and it's checksum is correct
+        text = d.decompress(compressed + '\0')
+        if d.unused_data != '\0':
+            raise zlib.error('Incomplete stream')
+        return text
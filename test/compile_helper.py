@@ -0,0 +1,60 @@
+import glob
+import os
+import random
+import shutil
+import tempfile
+from aardtools.compiler import Compiler, Volume
+from aarddict.dictionary import HEADER_SPEC, spec_len
+from aardtools.reader import Volume as Reader
+
+def make_articles():
+    words = ['%s%d' % (random.choice(('alpha', 'beta', 'gamma')), i)
+             for i in range(500)]
+    articles = [(word, ('["%s %s", [], {}]' % (word, ' text'*random.randint(1, 50))))
+                for word in words]
+    #identical bodies, shared within volume
+    articles += [(word + '-', '["", [], {"r": "%s"}]' % words[0])
+                 for word in words[:20]]
+    return articles
+
+articles = make_articles()
+
+def setup():
+    global work_dir
+    work_dir = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(work_dir)
+
+def volume_files(name):
+    return sorted(glob.glob(os.path.join(work_dir, name, '*.aar*')))
+
+def compile(name, max_file_size=2**31-1, add=None, **kwargs):
+    session_dir = os.path.join(work_dir, name)
+    os.mkdir(session_dir)
+    Volume.number = 0
+    c = Compiler(os.path.join(session_dir, name + '.aar'), max_file_size,
+                 session_dir, {}, **kwargs)
+    for title, article in articles:
+        if add:
+            add(c, title, article)
+        else:
+            c.add_article(title, article)
+    c.compile()
+    items = []
+    for file_name in volume_files(name):
+        reader = Reader(file_name)
+        assert reader.verify()
+        assert os.path.getsize(file_name) <= max_file_size
+        items.extend(reader.items())
+        reader.close()
+    return items
+
+def without_uuid(file_name):
+    """ Return content of volume file with checksum and uuid, the
+    only parts that differ between compilations, left out.
+    """
+    data = open(file_name, 'rb').read()
+    return (data[:spec_len(HEADER_SPEC[:1])] +
+            data[spec_len(HEADER_SPEC[:2]):spec_len(HEADER_SPEC[:3])] +
+            data[spec_len(HEADER_SPEC[:4]):])
@@ -0,0 +1,83 @@
+import os
+import tempfile
+from aardtools.articlecache import ArticleCache, CacheWriter, digest
+
+def setup():
+    global cache_file
+    fd, cache_file = tempfile.mkstemp(suffix='.cache')
+    os.close(fd)
+
+def teardown():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(cache_file + suffix):
+            os.remove(cache_file + suffix)
+
+pages = {u'Template:A': digest(u'{{{1}}}'), u'Template:B': None}
+
+def test_hit():
+    cache = ArticleCache(cache_file, 'salt')
+    key = cache.key(u'title', u'{{A|x}}')
+    cache.put(key, pages.items(), 'article', [[u'de', u'Titel']], 2.0)
+    cache.close()
+
+    cache = ArticleCache(cache_file, 'salt')
+    assert cache.key(u'title', u'{{A|x}}') == key
+    article, languagelinks, seconds = cache.get(key, pages.get)
+    assert article == 'article'
+    assert languagelinks == [[u'de', u'Titel']]
+    assert seconds == 2.0
+    cache.close()
+
+def test_changed_template():
+    cache = ArticleCache(cache_file, 'salt')
+    key = cache.key(u'changed', u'{{A|x}}')
+    cache.put(key, pages.items(), 'article', [], 1.0)
+    changed = dict(pages)
+    changed[u'Template:B'] = digest(u'new template')
+    assert cache.get(key, changed.get) is None
+    assert cache.get(key, pages.get)
+    cache.close()
+
+def test_salt():
+    cache = ArticleCache(cache_file, 'salt')
+    other = ArticleCache(cache_file, 'other salt')
+    assert cache.key(u'title', u'text') != other.key(u'title', u'text')
+    cache.close()
+    other.close()
+
+def test_prune():
+    cache = ArticleCache(cache_file, 'salt')
+    used = cache.key(u'used', u'text')
+    unused = cache.key(u'unused', u'text')
+    for key in (used, unused):
+        cache.put(key, [], 'article', [], 1.0)
+    cache.run += 1
+    cache.touch(used, 1.0)
+    assert cache.stats.hits == 1
+    cache.prune()
+    assert cache.get(used, pages.get)
+    assert cache.get(unused, pages.get) is None
+    cache.close()
+
+def test_writer():
+    writer = CacheWriter(cache_file, 'salt')
+    #schema is ready for readers as soon as writer is created
+    reader = ArticleCache(cache_file, 'salt')
+    written = reader.key(u'written', u'text')
+    stale = reader.key(u'stale', u'text')
+    #written by an earlier run
+    reader.run -= 1
+    reader.put(stale, [], 'stale article', [], 1.0)
+    reader.commit()
+    writer.put(written, pages.items(), 'article', [[u'de', u'Titel']], 2.0)
+    writer.touch(written, 1.5)
+    writer.commit()
+    assert reader.get(written, pages.get) == ('article', [[u'de', u'Titel']], 2.0)
+    assert writer.prune() == 1
+    assert reader.get(stale, pages.get) is None
+    assert writer.stats.misses == 1
+    assert writer.stats.hits == 1
+    assert writer.stats.saved == 1.5
+    writer.close()
+    assert not writer.process.is_alive()
+    reader.close()
@@ -0,0 +1,97 @@
+import os
+import compile_helper
+from aardtools import compiler
+from aardtools.articlecache import ArticleCache
+from compile_helper import setup, teardown, articles, compile
+
+def test_volume_processes():
+    compiler.set_compression_policy('best')
+    expected = compile('serial', 16*1024)
+    assert compile('parallel', 16*1024, volume_processes=3) == expected
+    compiler.set_compression_policy('none')
+    try:
+        assert compile('v2parallel', 16*1024, block_size=1024,
+                       volume_processes=3) == expected
+    finally:
+        compiler.set_compression_policy('best')
+
+def test_article_cache():
+    cache = ArticleCache(os.path.join(compile_helper.work_dir,
+                                      'articles.cache'), 'salt')
+    def add_cached(c, title, article):
+        #same as wiki converter: cached articles are compressed
+        #with current policy, new ones are cached uncompressed
+        key = cache.key(title.decode('utf8'), u'text')
+        cached = cache.get(key, lambda name: None)
+        if cached:
+            article = cached[0]
+        else:
+            cache.put(key, [], article, [], 1.0)
+        compressed, report = compiler.compress_with_codec(article)
+        c.add_compressed_article(title, compressed, report=report)
+    compiler.set_compression_policy('best')
+    try:
+        expected = compile('cachev1', add=add_cached)
+        assert cache.stats.misses == len(articles)
+        compiler.set_compression_policy('none')
+        assert compile('cachev2', block_size=1024, add=add_cached) == expected
+        compiler.compression_policy = compiler.DictionaryCompressionPolicy(
+            sample_size=100)
+        assert compile('cachezdict', add=add_cached) == expected
+    finally:
+        compiler.set_compression_policy('best')
+        cache.close()
+    assert expected == compile('nocache')
+
+def mkredirect(target):
+    """ Serialized redirect as converters made it before
+    :meth:`Compiler.add_redirect`.
+    """
+    return compiler.tojson(('', [], {u'r': target})).encode('utf8')
+
+targets = [title.decode('utf8') for title, article in articles[:100]]
+targets += [u'\u0430\u0431"', u'a\\b']
+
+def stored(name, add_redirect, **kwargs):
+    """ Add articles, each followed by a redirect added with
+    `add_redirect`, return compiler and stored titles and articles
+    in insertion order.
+    """
+    session_dir = os.path.join(compile_helper.work_dir, name)
+    os.mkdir(session_dir)
+    c = compiler.Compiler(os.path.join(session_dir, name + '.aar'),
+                          2**31-1, session_dir, {}, **kwargs)
+    added = []
+    for (title, article), target in zip(articles, targets):
+        c.add_article(title, article)
+        redirect_title = (u'%s >' % target).encode('utf8')
+        add_redirect(c, redirect_title, target)
+        added.extend((title, redirect_title))
+    c.collect_compressed()
+    c.store_writer.flush()
+    store = c.article_store
+    store.open()
+    records = [store.record(pos) for pos in xrange(store.count)]
+    items = [(store.title(r), store.article(r)) for r in records]
+    assert [title for title, article in items] == added
+    c.compile()
+    return c, dict(items[1::2])
+
+def test_redirects():
+    compiler.set_compression_policy('best')
+    def add_redirect(c, title, target):
+        c.add_redirect(title, target)
+    def add_article(c, title, target):
+        c.add_article(title, mkredirect(target), redirect=True)
+    for kwargs in ({}, {'compress_threads': 3}):
+        for add in (add_redirect, add_article):
+            name = '%s%d' % (add.__name__, len(kwargs))
+            c, redirects = stored(name, add, **kwargs)
+            assert len(redirects) == len(targets)
+            for target in targets:
+                title = (u'%s >' % target).encode('utf8')
+                assert redirects[title] == mkredirect(target)
+            assert c.stats.redirects == len(targets)
+            assert c.stats.redirect_stubs == len(targets)
+            assert c.stats.articles == len(targets)
+            assert c.stats.redirect_time > 0
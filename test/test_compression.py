@@ -0,0 +1,35 @@
+from aardtools import compiler
+from compile_helper import (setup, teardown, articles, compile,
+                            volume_files, without_uuid)
+
+def test_compress_threads():
+    compiler.set_compression_policy('best')
+    expected = compile('unthreaded', 16*1024)
+    assert compile('threaded', 16*1024, compress_threads=3) == expected
+    unthreaded, threaded = volume_files('unthreaded'), volume_files('threaded')
+    assert len(threaded) == len(unthreaded) > 1
+    for a, b in zip(unthreaded, threaded):
+        assert without_uuid(a) == without_uuid(b)
+
+def test_adaptive():
+    compiler.set_compression_policy('best')
+    expected = compile('notadaptive')
+    policy = compiler.AdaptiveCompressionPolicy(sample_size=20)
+    compiler.compression_policy = policy
+    try:
+        assert compile('adaptive', compress_threads=4) == expected
+    finally:
+        compiler.set_compression_policy('best')
+    assert policy.chosen
+    assert not set(policy.chosen) & set(policy.samples)
+    #articles of committed size class are compressed with chosen codec only
+    committed = 0
+    for title, article in articles:
+        chosen = policy.chosen.get(policy.size_class(len(article)))
+        if not chosen:
+            continue
+        assert len(chosen) == 1
+        compressed, report = policy.compress(article)
+        assert [name for name, seconds, length in report[3]] == [chosen[0].__name__]
+        committed += 1
+    assert committed
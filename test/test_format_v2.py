@@ -0,0 +1,64 @@
+import functools
+from aardtools import compiler
+from aardtools.reader import Volume as Reader
+from compile_helper import setup, teardown, articles, compile, volume_files
+
+def test_round_trip():
+    compiler.set_compression_policy('best')
+    expected = compile('v1')
+    compiler.set_compression_policy('none')
+    try:
+        assert compile('v2', block_size=1024) == expected
+        assert compile('v2split', 16*1024, block_size=1024) == expected
+    finally:
+        compiler.set_compression_policy('best')
+    assert len(expected) == len(articles)
+
+def test_compression_dictionary():
+    compiler.set_compression_policy('best')
+    expected = compile('nodict')
+    compiler.compression_policy = compiler.DictionaryCompressionPolicy(
+        sample_size=100)
+    try:
+        assert compile('zdict') == expected
+        assert compiler.compression_policy.compressor
+    finally:
+        compiler.set_compression_policy('best')
+    #files that need preset dictionary must not look like version 1
+    for name, version in (('nodict', 1), ('zdict', 3)):
+        for file_name in volume_files(name):
+            reader = Reader(file_name)
+            assert reader.version == version
+            reader.close()
+
+def test_block_compression_dictionary():
+    compiler.set_compression_policy('best')
+    expected = compile('blocknodict')
+    policies = compiler.compression_policies
+    zdict_policy = policies['zdict']
+    policies['zdict'] = functools.partial(
+        compiler.DictionaryCompressionPolicy, sample_size=100)
+    compiler.set_compression_policy('none')
+    try:
+        assert compile('blockzdict', 16*1024, block_size=1024,
+                       block_compression='zdict') == expected
+    finally:
+        policies['zdict'] = zdict_policy
+        compiler.set_compression_policy('best')
+    for file_name in volume_files('blockzdict'):
+        reader = Reader(file_name)
+        assert 'compression_dictionary' in reader.metadata
+        reader.close()
+
+def test_copy_slices():
+    compiler.set_compression_policy('best')
+    expected = compile('unsliced', 16*1024)
+    slice_size = compiler.COPY_SLICE_SIZE
+    compiler.COPY_SLICE_SIZE = 100
+    try:
+        assert compile('sliced', 16*1024) == expected
+        compiler.set_compression_policy('none')
+        assert compile('v2sliced', 16*1024, block_size=1024) == expected
+    finally:
+        compiler.COPY_SLICE_SIZE = slice_size
+        compiler.set_compression_policy('best')
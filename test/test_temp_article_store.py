@@ -1,6 +1,9 @@
+import os
 import random
+import shutil
 import string
-from aardtools.compiler import TempArticleStore
+import tempfile
+from aardtools.compiler import TempArticleStore, NO_DIGEST
 
 def setup():
     global store, data
@@ -27,3 +30,172 @@ def test_with_key():
     actual = list(store.sorted(key=lambda x: ''.join(reversed(x))))
     expected = sorted(data, key=lambda x: ''.join(reversed(x[0])))
     assert actual == expected, 'actual:\n%r\nexpected:\n%r\n' % (actual, expected)
+
+def test_external_sort():
+    small_store = TempArticleStore(sort_memory=1024)
+    try:
+        for title, article in data:
+            small_store.append(title, article)
+        assert list(small_store.sorted()) == list(store.sorted())
+    finally:
+        small_store.close()
+
+def test_precomputed_keys():
+    key_store = TempArticleStore()
+    try:
+        for title, article in data:
+            key_store.append(title, article, ''.join(reversed(title)))
+        def fail(title):
+            raise AssertionError('Key function called for %r' % title)
+        actual = list(key_store.sorted(key=fail))
+        expected = sorted(data, key=lambda x: ''.join(reversed(x[0])))
+        assert actual == expected
+    finally:
+        key_store.close()
+
+def test_partitioned_sort():
+    parallel_store = TempArticleStore(sort_memory=1024, sort_processes=3)
+    try:
+        for title, article in data:
+            parallel_store.append(title, article)
+        assert list(parallel_store.sorted()) == list(store.sorted())
+    finally:
+        parallel_store.close()
+
+def test_checkpoint():
+    interrupted = TempArticleStore()
+    half = len(data)/2
+    for title, article in data[:half]:
+        interrupted.append(title, article, title)
+    state = interrupted.checkpoint()
+    for title, article in data[half:]:
+        interrupted.append(title, 'lost ' + article)
+    for f in (interrupted.title_store, interrupted.store_idx,
+              interrupted.article_store, interrupted.key_store):
+        f.close()
+    resumed = TempArticleStore(state=state)
+    try:
+        assert resumed.count == half
+        for title, article in data[half:]:
+            resumed.append(title, article, title)
+        assert list(resumed.sorted()) == list(store.sorted())
+    finally:
+        resumed.close()
+
+def test_dedup():
+    dup_store = TempArticleStore()
+    try:
+        for title, article in data:
+            dup_store.append(title, article)
+            dup_store.append(title + '~', article)
+        count, length = dup_store.dedup()
+        unique = set(article for title, article in data)
+        assert count == 2*len(data) - len(unique)
+        assert length == (2*sum(len(article) for title, article in data) -
+                          sum(len(article) for article in unique))
+        dup_store.sort()
+        bodies = {}
+        for record, offset, new in dup_store.volume_articles(0, dup_store.count):
+            article = dup_store.article(record)
+            if new:
+                assert offset not in bodies
+                bodies[offset] = article
+            else:
+                assert bodies[offset] == article
+        assert len(bodies) == len(unique)
+        assert sorted(dup_store.sorted()) == sorted(
+            data + [(title + '~', article) for title, article in data])
+    finally:
+        dup_store.close()
+
+def test_dedup_empty():
+    empty_store = TempArticleStore()
+    try:
+        assert empty_store.dedup() == (0, 0)
+        empty_store.sort()
+        assert list(empty_store.sorted()) == []
+    finally:
+        empty_store.close()
+
+def test_no_dedup():
+    plain_store = TempArticleStore(dedup=False)
+    try:
+        for title, article in data:
+            plain_store.append(title, article)
+        plain_store.open()
+        for pos in xrange(plain_store.count):
+            assert plain_store.record(pos)[6] == NO_DIGEST
+        plain_store.sort()
+        assert sorted(plain_store.sorted()) == sorted(data)
+    finally:
+        plain_store.close()
+
+def test_prefetch():
+    for prefetch_size in (0, 64):
+        prefetch_store = TempArticleStore(prefetch_size=prefetch_size)
+        try:
+            for title, article in data:
+                prefetch_store.append(title, article)
+            assert list(prefetch_store.sorted()) == list(store.sorted())
+            assert prefetch_store.stall >= 0
+        finally:
+            prefetch_store.close()
+
+def test_work_dirs():
+    dirs = [tempfile.mkdtemp() for i in range(3)]
+    striped_store = TempArticleStore(work_dir=dirs[:2], hot_dir=dirs[2])
+    try:
+        for title, article in data:
+            striped_store.append(title, article)
+        assert list(striped_store.sorted()) == list(store.sorted())
+        assert os.path.dirname(striped_store.article_store_name) == dirs[0]
+        for name in (striped_store.title_store_name,
+                     striped_store.store_idx_name,
+                     striped_store.key_store_name,
+                     striped_store.order_name):
+            assert os.path.dirname(name) == dirs[2]
+    finally:
+        striped_store.close()
+        for d in dirs:
+            shutil.rmtree(d)
+
+def test_presorted():
+    expected = sorted(data, key=lambda x: x[0])
+    for presorted in (False, True):
+        sorted_store = TempArticleStore(presorted=presorted)
+        try:
+            for title, article in expected:
+                sorted_store.append(title, article, title)
+            assert sorted_store.in_order
+            assert sorted_store.key_start == (0 if presorted else
+                                              sum(len(title) for title, article
+                                                  in expected))
+            assert list(sorted_store.sorted()) == expected
+        finally:
+            sorted_store.close()
+
+def test_presorted_out_of_order():
+    broken_store = TempArticleStore(presorted=True)
+    try:
+        for title, article in data:
+            broken_store.append(title, article, title)
+        assert not broken_store.in_order
+        assert list(broken_store.sorted()) == list(store.sorted())
+    finally:
+        broken_store.close()
+
+def test_partitioned_sort_stopped():
+    work_dir = tempfile.mkdtemp()
+    parallel_store = TempArticleStore(work_dir=work_dir, sort_memory=1024,
+                                      sort_processes=3)
+    try:
+        for title, article in data:
+            parallel_store.append(title, article)
+        names = set(os.listdir(work_dir))
+        positions = parallel_store.sort_positions(lambda i: str(i))
+        assert positions.next() == 0
+        positions.close()
+        assert set(os.listdir(work_dir)) == names
+    finally:
+        parallel_store.close()
+        shutil.rmtree(work_dir)
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import time
+from aardtools import wiki
+from aardtools.compiler import Compiler
+from aardtools.workers import WorkerPool
+
+def setup():
+    global work_dir, wiki_convert, wiki_init_worker
+    work_dir = tempfile.mkdtemp()
+    #workers are forked after module globals are replaced
+    wiki_convert, wiki_init_worker = wiki.convert, wiki._init_worker
+    wiki.convert = convert
+    wiki._init_worker = lambda: None
+
+def teardown():
+    wiki.convert, wiki._init_worker = wiki_convert, wiki_init_worker
+    shutil.rmtree(work_dir)
+
+def convert(title):
+    if title.startswith('stuck'):
+        time.sleep(60)
+    elif title.startswith('slow'):
+        #longer than timeout, shorter than retry timeout
+        time.sleep(1.5)
+    elif title.startswith('fail'):
+        raise wiki.ConvertError(title)
+    elif title.startswith('empty'):
+        raise wiki.EmptyArticleError(title)
+    return (title, 'article', False, None, 7, title.encode('utf8'),
+            None, None)
+
+class Consumer(Compiler):
+    """ Compiler that records added articles instead of storing
+    them.
+    """
+
+    def __init__(self, name):
+        session_dir = os.path.join(work_dir, name)
+        os.mkdir(session_dir)
+        Compiler.__init__(self, os.path.join(session_dir, name + '.aar'),
+                          2**31-1, session_dir)
+        self.added = []
+
+    def add_compressed_article(self, title, compressed_article, *args):
+        self.added.append(title)
+
+    def close(self):
+        self.store_writer.close()
+        self.article_store.close()
+        self.close_lists()
+
+    def timedout_titles(self):
+        with open(self.timedout_articles.name) as f:
+            return f.read().splitlines()
+
+class Parser(wiki.WikiParser):
+    """ WikiParser without site info and wiki db. """
+
+    def __init__(self, consumer, retry_processes):
+        self.consumer = consumer
+        self.timeout = 1
+        self.timeout_per_kb = 0
+        self.retry_processes = retry_processes
+        self.retry_timeout_factor = 4
+        self.retry_pool = None
+        self.sizes = {}
+        self.worker_tasks = None
+        self.requested_article_count = 0
+        self.real_article_count = 0
+        self.lang_links_langs = frozenset()
+        self.article_cache = None
+        self.pool = WorkerPool(processes=2, timeout=self.article_timeout)
+
+    def close(self):
+        self.pool.terminate()
+        if self.retry_pool:
+            self.retry_pool.terminate()
+
+def run(name, titles, retry_processes):
+    consumer = Consumer(name)
+    parser = Parser(consumer, retry_processes)
+    try:
+        assert not parser.convert_chunk(None, titles)
+    finally:
+        parser.close()
+        consumer.close()
+    return consumer
+
+titles = ([u'article%d' % i for i in range(10)] +
+          [u'slow1', u'slow2', u'stuck1', u'fail1', u'empty1'])
+
+def test_retry():
+    consumer = run('retry', titles, 1)
+    assert sorted(consumer.added) == sorted(titles[:12])
+    assert consumer.timedout_titles() == ['stuck1']
+    stats = consumer.stats
+    assert stats.timedout == 1
+    assert stats.recovered == 2
+    assert stats.failed == 1
+    assert stats.empty == 1
+
+def test_no_retry():
+    consumer = run('noretry', titles, 0)
+    assert sorted(consumer.added) == sorted(titles[:10])
+    assert sorted(consumer.timedout_titles()) == ['slow1', 'slow2', 'stuck1']
+    stats = consumer.stats
+    assert stats.timedout == 3
+    assert stats.recovered == 0
+    assert stats.failed == 1
+    assert stats.empty == 1
@@ -0,0 +1,113 @@
+import os
+import time
+from aardtools.workers import WorkerPool, TaskTimeout, WorkerExited
+
+def work(item):
+    if item == 'stuck':
+        time.sleep(60)
+    elif item == 'fail':
+        raise ValueError(item)
+    elif item == 'exit':
+        os._exit(1)
+    elif item == 'slow':
+        time.sleep(0.2)
+    elif item.startswith('slower'):
+        time.sleep(0.3)
+    return item, os.getpid()
+
+def run(items, **kwargs):
+    pool = WorkerPool(**kwargs)
+    try:
+        return dict((item, (result, error)) for item, result, error
+                    in pool.imap_unordered(work, items))
+    finally:
+        pool.close()
+
+def test_results():
+    items = ['item%d' % i for i in range(20)] + ['fail']
+    results = run(items, processes=3)
+    assert sorted(results) == sorted(items)
+    for item in items[:-1]:
+        assert results[item][0][0] == item
+        assert results[item][1] is None
+    assert isinstance(results['fail'][1], ValueError)
+
+def test_timeout():
+    items = ['slow'] + ['item%d' % i for i in range(10)] + ['stuck']
+    t0 = time.time()
+    results = run(items, processes=2, timeout=1)
+    assert time.time() - t0 < 10
+    assert isinstance(results['stuck'][1], TaskTimeout)
+    for item in items[:-1]:
+        assert results[item][1] is None
+
+def test_worker_exit():
+    results = run(['exit', 'item1', 'item2'], processes=1)
+    assert isinstance(results['exit'][1], WorkerExited)
+    assert results['item2'][1] is None
+
+def test_maxtasks():
+    results = run(['item%d' % i for i in range(6)], processes=1, maxtasks=2)
+    pids = set(result[1] for result, error in results.itervalues())
+    assert len(pids) == 3
+
+def test_item_timeout():
+    timeouts = {'slow': 0.1}
+    results = run(['slow', 'item1'], processes=2,
+                  timeout=lambda item: timeouts.get(item, 5))
+    assert isinstance(results['slow'][1], TaskTimeout)
+    assert results['item1'][1] is None
+
+def test_stats():
+    pool = WorkerPool(processes=2)
+    try:
+        list(pool.imap_unordered(work, ['slow', 'slow', 'item1']))
+        busy_time, available_time = pool.take_stats()
+        assert 0.4 <= busy_time <= available_time
+        assert pool.take_stats() == (0, 0)
+    finally:
+        pool.close()
+
+def test_batches():
+    pool = WorkerPool(processes=2, timeout=1)
+    try:
+        items = ['item%d' % i for i in range(500)] + ['stuck', 'fail']
+        results = dict((item, (result, error)) for item, result, error
+                       in pool.imap_unordered(work, items))
+        assert pool.batch_size() > 1
+        pool.reset_batch_size()
+        assert pool.batch_size() == 1
+    finally:
+        pool.close()
+    assert sorted(results) == sorted(items)
+    assert isinstance(results['stuck'][1], TaskTimeout)
+    assert isinstance(results['fail'][1], ValueError)
+    for item in items[:-2]:
+        assert results[item] == ((item, results[item][0][1]), None)
+
+def test_batch_item_timeouts():
+    #batches sized for fast items, each slow item fits it's timeout
+    items = (['item%d' % i for i in range(3000)] +
+             ['slower%d' % i for i in range(20)])
+    results = run(items, processes=2, timeout=1)
+    assert sorted(results) == sorted(items)
+    for item in items:
+        assert results[item][1] is None
+    assert len(set(result[1] for result, error in results.itervalues())) == 2
+
+def test_slow_caller():
+    #time caller spends on a result doesn't count against the
+    #timeout of next item in the batch
+    items = (['item%d' % i for i in range(200)] +
+             ['slower%d' % i for i in range(6)])
+    pool = WorkerPool(processes=1, timeout=0.5)
+    errors = {}
+    try:
+        for item, result, error in pool.imap_unordered(work, items):
+            errors[item] = error
+            if item == 'slower0':
+                #next item is done meanwhile, the one after isn't
+                time.sleep(0.4)
+    finally:
+        pool.close()
+    assert errors == dict((item, None) for item in items)